@@ -5,58 +5,90 @@ import sys
 import os
 import os.path
 import sqlite3
-import re
-import json
 import time
-import datetime
 import collections
-import argparse
-
-def rename_tag_in_notes(conn, tag, dst):
-    """Renames a single tag in all notes"""
-    n = 0
-    found = []
-    for row in conn.execute("select * from notes where tags like ?",
-                            ('%'+tag+'%',)):
-        tags = row['tags'].split()
-        # Searching again because sql will return tags containing the tag we're
-        # looking for, e.g. if src is 'a', sql will return 'a', 'ab', etc. We
-        # will only rename the exact match
-        if tag in tags:
-            found.append(dict(row))
-
-    for row in found:
-        tags = row['tags'].split()
-        tags.remove(tag)
-        if dst:
-            tags.append(dst)
-        # remove duplicates and sort
-        tags = sorted(set(tags))
+import itertools
+
+def rename_tags_in_notes(conn, stages):
+    """Renames or removes tags in all notes. stages is a list of lists of (tag,
+    destination) pairs, applied in order, with an empty destination meaning
+    the tag should be removed. The notes' tags are read only once into an
+    inverted index, and only notes whose tags changed are written back.
+    Returns a list of (tag, destination, number of notes) tuples"""
+    renamed = set(tag for stage in stages for tag, _ in stage)
+    tags_index = collections.defaultdict(set)
+    notes_tags = dict()
+
+    # the search index, if used, tells which notes are tagged with any of the
+    # tags, otherwise every note must be read
+    index = use_index and open_index(conn)
+    if index:
+        note_ids = get_tagged_notes(index, renamed)
+        index.close()
+        rows = (row for chunk in read_rows_by_id(conn, 'notes', 'tags', note_ids)
+                for _, row in chunk if row)
+    else:
+        rows = conn.execute('select id,tags from notes')
+    for note_id, tagsstr in rows:
+        tags = tagsstr.split()
+        found = renamed.intersection(tags)
+        if found:
+            notes_tags[note_id] = set(tags)
+            for tag in found:
+                tags_index[tag].add(note_id)
+
+    changed = set()
+    counts = []
+    for stage in stages:
+        for tag, dst in stage:
+            note_ids = tags_index.pop(tag, set())
+            for note_id in note_ids:
+                tags = notes_tags[note_id]
+                tags.discard(tag)
+                if dst:
+                    tags.add(dst)
+            # later stages may rename the destination again
+            if dst and dst in renamed:
+                tags_index[dst] |= note_ids
+            changed |= note_ids
+            counts.append((tag, dst, len(note_ids)))
+
+    writer = NotesWriter(conn, ['tags'])
+    for note_id in sorted(changed):
+        # sorted and without duplicates
+        tags = sorted(notes_tags[note_id])
         if not tags:
             tagstr = ''
         else:
             tagstr = ' {} '.format(' '.join(tags))
-        conn.execute('update notes set tags=?,mod=?,usn=? where id=?',
-                       (tagstr, int(time.time()), -1, row['id']))
-        n += 1
+        writer.add(note_id, tagstr)
+    writer.flush()
+    return counts
+
+def rename_tag_in_notes(conn, tag, dst):
+    """Renames a single tag in all notes"""
+    for tag, dst, n in rename_tags_in_notes(conn, [[(tag, dst)]]):
+        print_tag_renamed(tag, dst, n)
 
+def print_tag_renamed(tag, dst, n):
     if not quiet:
         if n > 0:
             if dst:
                 verb = 'renamed'
             else:
                 verb = 'removed'
-                print('Tag ‘'+tag+'’ successfully', verb, 'in',
-                       n, 'notes.', file=sys.stderr)
+            renderer.err('Tag ‘{}’ successfully {} in {} notes.\n'.format(
+                             tag, verb, n))
         else:
-            print('Tag ‘'+tag+'’ not found in any notes.', file=sys.stderr)
+            renderer.err('Tag ‘'+tag+'’ not found in any notes.\n')
 
 def rename_tags(conn, tags, remove=False):
     """Renames or removes all tags matching regular expressions"""
 
+    import json
+    import re
     if not remove and len(tags) < 2:
-        print('Usage: mv_tags regex [regex]... destination',
-              file=sys.stderr)
+        renderer.err('Usage: mv_tags regex [regex]... destination\n')
         return False
     elif remove and not tags:
         tags = []
@@ -72,51 +104,59 @@ def rename_tags(conn, tags, remove=False):
         dst = None
         srcs = tags
 
-    row = conn.execute("select * from col where id=1").fetchone()
+    row = conn.execute("select tags from col where id=1").fetchone()
     if not row:
-        print("Couldn't read collection.")
+        renderer.out("Couldn't read collection.\n")
         return False
 
     try:
-        tagsdict = json.loads(row['tags'])
+        tagsdict = json.loads(row[0])
         if type(tagsdict) != dict:
             raise ValueError
     except ValueError:
-        print("Couldn't decode tags string:", row['tags'], file=sys.stderr)
+        renderer.err("Couldn't decode tags string: "+row[0]+'\n')
         return False
 
+    # working out every rename first, so notes only need to be read once
     n = 0
+    stages = []
     for target in srcs:
-        found = False
+        stage = []
+        regex = re.compile(target, re.I)
         keys = list(tagsdict.keys())
         for tag in keys:
-            if re.search(target, tag, re.I):
-                found = True
+            if regex.search(tag):
                 n += 1
                 del tagsdict[tag]
-                dsttag = re.sub(target, dst, tag)
                 if dst:
+                    dsttag = re.sub(target, dst, tag)
                     tagsdict[dsttag] = -1
-
-                try:
-                    print("replace tag ", tag, " with ", dsttag)
-                    rename_tag_in_notes(conn, tag, dsttag)
-                except sqlite3.OperationalError:
-                    return False
-        if not found:
+                else:
+                    dsttag = None
+                renderer.out('replace tag  {}  with  {}\n'.format(tag, dsttag))
+                stage.append((tag, dsttag))
+        if not stage:
             if not quiet:
-                print("Couldn't find tags matching ‘{}’, searching notes",
-                      "for exact string.".format(target), file=sys.stderr)
-            try:
-                dsttag = re.sub(target, dst, tag)
-                print("replace tag ", tag, " with ", dsttag, " (notfound?)")
-                rename_tag_in_notes(conn, target, dsttag)
-            except sqlite3.OperationalError:
-                return False
+                renderer.err("Couldn't find tags matching ‘{}’, searching "
+                             "notes for exact string.\n".format(target))
+            if dst:
+                dsttag = re.sub(target, dst, target)
+            else:
+                dsttag = None
+            renderer.out('replace tag  {}  with  {}  (notfound?)\n'.format(
+                             target, dsttag))
+            stage.append((target, dsttag))
+        stages.append(stage)
+
+    try:
+        for tag, dsttag, count in rename_tags_in_notes(conn, stages):
+            print_tag_renamed(tag, dsttag, count)
+    except sqlite3.OperationalError:
+        return False
 
     tagstr = json.dumps(tagsdict)
-    conn.execute('update col set tags=?,mod=? where id=?',
-                   (tagstr, int(time.time()*1000), row['id']))
+    conn.execute('update col set tags=?,mod=? where id=1',
+                   (tagstr, int(time.time()*1000)))
 
     if not remove:
         verb = 'renamed'
@@ -124,10 +164,10 @@ def rename_tags(conn, tags, remove=False):
         verb = 'removed'
     if n == 0:
         if not quiet:
-            print('No tags were', verb, file=sys.stderr)
+            renderer.err('No tags were {}\n'.format(verb))
         return False
     elif not quiet:
-        print(n, 'tag(s) successfully', verb, file=sys.stderr)
+        renderer.err('{} tag(s) successfully {}\n'.format(n, verb))
 
     return True
 
@@ -137,32 +177,871 @@ def remove_tags(conn, tags):
 def get_card_ids(conn, note_id, return_deck_id=False):
     card_ids = []
     deck_id = None
-    for row in conn.execute("select id,did from cards where nid = ?", (note_id,)):
-        card_ids.append(row['id'])
-        deck_id = row['did']
+    for card_id, deck_id in conn.execute("select id,did from cards where nid = ?",
+                                         (note_id,)):
+        card_ids.append(card_id)
     if return_deck_id:
         return card_ids, deck_id
     return card_ids
 
+def get_cards_map(conn, note_ids=None, note_range=None):
+    """Maps every note id (or only those in note_ids, or between the first and
+    last ids in note_range) to its card ids and deck id, reading the cards
+    table only once instead of once per note. With the --snapshot switch, the
+    returned map looks card ids up in the snapshot instead"""
+    snapshot = get_snapshot(conn)
+    if snapshot:
+        return SnapshotCardsMap(snapshot)
+    cards_map = dict()
+    if note_ids is not None:
+        where = ' where nid in ({})'.format(','.join('?'*len(note_ids)))
+        params = list(note_ids)
+    elif note_range is not None:
+        where = ' where nid between ? and ?'
+        params = list(note_range)
+    else:
+        where = ''
+        params = []
+    for card_id, note_id, deck_id in conn.execute('select id,nid,did from cards'+
+                                                  where+' order by nid,id',
+                                                  params):
+        entry = cards_map.get(note_id)
+        if entry is None:
+            cards_map[note_id] = [[card_id], deck_id]
+        else:
+            entry[0].append(card_id)
+            entry[1] = deck_id
+    return cards_map
+
+# number of ids read with a single query by the print_* functions, small
+# enough to stay within sqlite's limit on the number of parameters
+chunk_size = 500
+
+def read_rows_by_id(conn, table, columns, ids):
+    """Reads the rows with the given ids from table, chunk_size ids per query.
+    Yields lists of (id, row) pairs in the same order as ids, with row being
+    None for ids that weren't found. Rows are read from the snapshot instead
+    when the --snapshot switch is used"""
+    snapshot = get_snapshot(conn)
+    ids = iter(ids)
+    while True:
+        chunk = list(itertools.islice(ids, chunk_size))
+        if not chunk:
+            break
+        keys = []
+        for _id in chunk:
+            try:
+                keys.append(int(_id))
+            except ValueError:
+                keys.append(None)
+        valid_keys = [key for key in keys if key is not None]
+        rows = dict()
+        if valid_keys and snapshot:
+            rows = snapshot.read_rows(table, columns, valid_keys)
+        elif valid_keys:
+            query = 'select id,{} from {} where id in ({})'.format(
+                        columns, table, ','.join('?'*len(valid_keys)))
+            for row in conn.execute(query, valid_keys):
+                rows[row[0]] = row
+        yield [(_id, rows.get(key)) for _id, key in zip(chunk, keys)]
+
 def get_note_id(conn, card_id):
     # id is unique
     row = conn.execute("select nid from cards where id = ?", (card_id,)).fetchone()
     if row:
-        return row['nid']
+        return row[0]
     return None
 
-def search_notes(conn, regexps, only_field=None, only_tags=False, cards=False):
-    if not regexps:
-        regexps = []
+class LazyPattern(object):
+    """A regular expression compiled when it's first used, so commands using
+    none don't import re. The compiled pattern then replaces it in the
+    module's globals"""
+
+    def __init__(self, name, pattern):
+        self.name = name
+        self.pattern = pattern
+
+    def __getattr__(self, attribute):
+        import re
+        compiled = re.compile(self.pattern)
+        globals()[self.name] = compiled
+        return getattr(compiled, attribute)
+
+# html tags, removed from fields before searching them
+html_tag_re = LazyPattern('html_tag_re', '<[^>]*>')
+# html tags anki uses for line breaks in fields
+line_break_re = LazyPattern('line_break_re', '</div>|<br[^>]*>')
+
+def html_to_text(value):
+    """Strips html from a field, replacing </div> and <br>s with line breaks,
+    since that's how anki handles line breaks in fields"""
+    if '<' not in value:
+        return value.rstrip()
+    return html_tag_re.sub('', line_break_re.sub('\n', value).rstrip())
+
+def same_file(a, b):
+    """Returns whether two streams write to the same file, e.g. the same
+    terminal"""
+    try:
+        a = os.fstat(a.fileno())
+        b = os.fstat(b.fileno())
+    except (AttributeError, OSError, ValueError):
+        return False
+    return (a.st_dev, a.st_ino) == (b.st_dev, b.st_ino)
+
+class Renderer(object):
+    """Collects the text printed by the print_* functions and writes it in
+    chunks of at least limit characters. When stdout and stderr are the same
+    file (e.g. both are a terminal), stderr's text is written as it comes, so
+    both streams stay in order"""
+    __slots__ = ('out_chunks', 'err_chunks', 'size', 'limit', 'interleaved')
+
+    def __init__(self, limit=0):
+        self.out_chunks = []
+        self.err_chunks = []
+        self.size = 0
+        self.limit = limit
+        self.interleaved = same_file(sys.stdout, sys.stderr)
+
+    def out(self, text):
+        self.out_chunks.append(text)
+        self.size += len(text)
+        if self.size >= self.limit:
+            self.flush()
+
+    def err(self, text):
+        if self.interleaved:
+            self.flush()
+            sys.stderr.write(text)
+            return
+        self.err_chunks.append(text)
+        self.size += len(text)
+        if self.size >= self.limit:
+            self.flush()
+
+    def flush(self):
+        if self.err_chunks:
+            sys.stderr.write(''.join(self.err_chunks))
+            self.err_chunks = []
+        if self.out_chunks:
+            sys.stdout.write(''.join(self.out_chunks))
+            self.out_chunks = []
+        self.size = 0
+
+# writes right away, unless replaced by execute with a buffering renderer
+renderer = Renderer()
+
+# text execute prints only once the command's changes are committed, such as
+# the ids of new notes, or None when not run by execute
+committed_output = None
+
+def out_committed(text):
+    """Prints text once the command's changes are committed, so it's not
+    printed when they're canceled"""
+    if committed_output is None:
+        renderer.out(text)
+    else:
+        committed_output.append(text)
+# number of characters buffered by the renderer before writing them
+renderer_limit = 1 << 16
+
+class Matcher(object):
+    """Compiled set of search patterns. A list of targets matches if every
+    pattern matches at least one of them, except for patterns starting with
+    '!', which match if they are not found in any target"""
+    __slots__ = ('patterns',)
+
+    def __init__(self, regexps, case_sensitive=False):
+        import re
+        flags = 0 if case_sensitive else re.I
+        self.patterns = []
+        for regex in regexps:
+            inverted = regex.startswith('!')
+            if inverted:
+                regex = regex[1:]
+            self.patterns.append((re.compile(regex, flags).search, inverted))
+
+    def match(self, targets, groups=None):
+        """Returns whether targets match all patterns. If groups is a list,
+        the strings matched by each pattern are appended to it"""
+        for search, inverted in self.patterns:
+            found = False
+            for string in targets:
+                r = search(string)
+                if r:
+                    found = True
+                    if inverted or groups is None:
+                        break
+                    groups.append(r.group())
+            # if one pattern failed to match, don't bother with the rest
+            if found == inverted:
+                return False
+        return True
+
+# a pattern that only matches a literal string, optionally anchored
+literal_pattern_re = LazyPattern('literal_pattern_re', r'(?:\^|\\b)?((?:[^\\.^$*+?{}\[\]|()]|\\[^0-9A-Za-z])+)(?:\$|\\b)?')
+escaped_char_re = LazyPattern('escaped_char_re', r'\\(.)')
+
+def get_pattern_literal(regex):
+    """Returns the literal string any match of regex must contain, or None if
+    the pattern is not a plain literal"""
+    if regex.startswith('!'):
+        return None
+    m = literal_pattern_re.fullmatch(regex)
+    if not m:
+        return None
+    return escaped_char_re.sub(r'\1', m.group(1))
+
+def like_pattern(literal, start='%', end='%'):
+    """Converts a literal into a case-insensitive like pattern matching at
+    least everything re.I would, between start and end. Sqlite only folds
+    ascii letters, so other cased characters (and 'i', 'k' and 's', which re.I
+    also matches against non-ascii letters) are replaced with a single
+    character wildcard"""
+    chars = [start]
+    for c in literal:
+        if c in '%_\\':
+            chars.append('\\'+c)
+        elif c in 'iksIKS':
+            chars.append('_')
+        elif c.isascii() or c.lower() == c.upper() == c.casefold():
+            chars.append(c)
+        else:
+            chars.append('_')
+    chars.append(end)
+    return ''.join(chars)
+
+def plan_search(regexps, only_field=None, only_tags=False, model_ids=None,
+                deck_ids=None, note_ids=None):
+    """Translates the parts of a search sqlite can check by itself into a
+    where clause, so only the rows surviving it need to be matched in python.
+    Returns the clause and its parameters"""
+    import json
+    conditions = []
+    params = []
+
+    # fields are searched with their html stripped, so literals can only be
+    # looked for in the raw column when searching tags or unstripped fields
+    if only_tags:
+        column = 'tags'
+    elif only_field:
+        column = 'flds'
+    else:
+        column = None
+    if column:
+        for regex in regexps:
+            literal = get_pattern_literal(regex)
+            if not literal:
+                continue
+            if case_sensitive:
+                conditions.append('instr({},?)'.format(column))
+                params.append(literal)
+            else:
+                conditions.append("{} like ? escape '\\'".format(column))
+                params.append(like_pattern(literal))
+
+    if model_ids:
+        conditions.append('mid in ({})'.format(','.join('?'*len(model_ids))))
+        params.extend(model_ids)
+    if deck_ids:
+        conditions.append('id in (select nid from cards where did in ({}))'
+                          .format(','.join('?'*len(deck_ids))))
+        params.extend(deck_ids)
+    if note_ids is not None:
+        conditions.append('id in (select value from json_each(?))')
+        params.append(json.dumps(note_ids))
+
+    if not conditions:
+        return '', params
+    return ' where '+' and '.join(conditions), params
+
+def get_collection_path(conn):
+    """Returns the file the collection was opened from, or None if it lives
+    in memory"""
+    for _, name, path in conn.execute('pragma database_list'):
+        if name == 'main':
+            return path or None
+    return None
+
+def get_file_key(path):
+    """Returns the modification times and sizes of a collection's file and its
+    write-ahead log, which change whenever anything is written to it"""
+    key = []
+    for name in (path, path+'-wal'):
+        try:
+            stat = os.stat(name)
+            key += [stat.st_mtime_ns, stat.st_size]
+        except OSError:
+            key += [None, None]
+    return key
+
+def get_index_path(conn):
+    path = get_collection_path(conn)
+    if not path:
+        return None
+    return os.path.splitext(path)[0]+'.anki_tool_index'
+
+# indexes created by other versions are rebuilt from scratch
+index_version = 3
+index_schema = """
+create table if not exists meta (key text primary key, value);
+create table if not exists notes (id integer primary key, mod integer not null,
+                                  usn integer not null);
+create virtual table if not exists notes_fts using fts5(flds, tags);
+create table if not exists tags (tag text not null collate nocase,
+                                 nid integer not null,
+                                 primary key (tag, nid)) without rowid;
+create index if not exists ix_tags_nid on tags (nid);
+"""
+
+def index_notes(index, rows):
+    """Adds notes to the search index, or replaces them, from rows of their
+    id, mod, usn, flds and tags"""
+    index.executemany('delete from notes_fts where rowid=?',
+                      [(row[0],) for row in rows])
+    index.executemany('insert into notes_fts (rowid,flds,tags) '
+                      'values (?,?,?)',
+                      [(row[0], html_tag_re.sub('', row[3]), row[4])
+                       for row in rows])
+    index.executemany('delete from tags where nid=?',
+                      [(row[0],) for row in rows])
+    # tags differing only in case are stored once per note
+    index.executemany('insert or ignore into tags (tag,nid) values (?,?)',
+                      [(tag, row[0]) for row in rows
+                       for tag in row[4].split()])
+    index.executemany('insert or replace into notes (id,mod,usn) '
+                      'values (?,?,?)',
+                      [(row[0], row[1], row[2]) for row in rows])
+
+def update_index(conn, index):
+    """Brings the search index up to date with the notes modified or synced
+    since it was last updated, and drops notes that were deleted from the
+    collection. Nothing is read when the collection wasn't written to since"""
+    # the file changes whenever anything is written to the collection, and
+    # col.mod whenever anki modifies it, even within the file's time
+    # resolution
+    import json
+    key = get_file_key(get_collection_path(conn))
+    key.append(conn.execute('select mod from col where id=1').fetchone()[0])
+    key = json.dumps(key)
+    row = index.execute("select value from meta where key='key'").fetchone()
+    if row and row[0] == key:
+        return 0
+
+    row = index.execute("select value from meta where key='mod'").fetchone()
+    watermark = row[0] if row else -1
+    row = index.execute("select value from meta where key='usn'").fetchone()
+    usn_watermark = row[0] if row else -1
+    # notes edited on another device keep the time they were edited there
+    # when synced, so only their usn, which sync sets to the server's, tells
+    # they changed
+    condition = ' where mod >= ? or usn > ?'
+    params = (watermark, usn_watermark)
+    indexed = dict((row[0], row[1:]) for row in index.execute(
+                       'select id,mod,usn from notes'+condition, params))
+
+    n = 0
+    cursor = conn.execute('select id,mod,usn,flds,tags from notes'+condition,
+                          params)
+    while True:
+        rows = cursor.fetchmany(1000)
+        if not rows:
+            break
+        # notes modified in the same second as the watermark were already
+        # read by the last update, unless they were modified again
+        rows = [row for row in rows
+                if indexed.get(row[0]) != (row[1], row[2])]
+        index_notes(index, rows)
+        for row in rows:
+            watermark = max(watermark, row[1])
+            usn_watermark = max(usn_watermark, row[2])
+        n += len(rows)
+
+    # comparing ids, since notes deleted and notes added without reaching
+    # the watermarks could leave the counts equal. sqlite joins them into a
+    # string much faster than python reads them, so they're only read when
+    # they differ
+    ids_query = 'select group_concat(id) from (select id from notes order by id)'
+    if (conn.execute(ids_query).fetchone()[0] ==
+            index.execute(ids_query).fetchone()[0]):
+        existing = indexed = set()
+    else:
+        existing = set(row[0] for row in conn.execute('select id from notes'))
+        indexed = set(row[0] for row in index.execute('select id from notes'))
+    deleted = [(_id,) for _id in indexed-existing]
+    if deleted:
+        index.executemany('delete from notes_fts where rowid=?', deleted)
+        index.executemany('delete from tags where nid=?', deleted)
+        index.executemany('delete from notes where id=?', deleted)
+        n += len(deleted)
+    missing = existing-indexed
+    if missing:
+        rows = conn.execute('select id,mod,usn,flds,tags from notes where id '
+                            'in (select value from json_each(?))',
+                            (json.dumps(sorted(missing)),)).fetchall()
+        index_notes(index, rows)
+        for row in rows:
+            watermark = max(watermark, row[1])
+            usn_watermark = max(usn_watermark, row[2])
+        n += len(rows)
+
+    index.executemany('insert or replace into meta (key,value) values (?,?)',
+                      [('mod', watermark), ('usn', usn_watermark),
+                       ('key', key)])
+    index.commit()
+    return n
+
+def open_index(conn):
+    """Opens the search index kept next to the collection, creating it if
+    needed, and updates it. Returns None if the index can't be used, in which
+    case searches should fall back to scanning the collection"""
+    path = get_index_path(conn)
+    if not path:
+        return None
+    # uncommitted changes could still be rolled back, after which the index
+    # would have no way to notice them
+    if conn.in_transaction:
+        return None
+    try:
+        index = sqlite3.connect(path)
+        index.executescript(index_schema)
+        row = index.execute("select value from meta "
+                            "where key='version'").fetchone()
+        if not row or row[0] != index_version:
+            index.executescript("""
+                drop table meta;
+                drop table notes;
+                drop table notes_fts;
+                drop table tags;
+                """)
+            index.executescript(index_schema)
+            index.execute("insert into meta (key,value) values ('version',?)",
+                          (index_version,))
+        n = update_index(conn, index)
+    except sqlite3.Error as e:
         if not quiet:
-            print('Reading from stdin...', file=sys.stderr)
-        for regex in sys.stdin:
-            regexps.append(regex.rstrip())
+            renderer.err("Couldn't use search index, searching the whole "
+                         "collection: {}\n".format(e))
+        return None
+    if n and not quiet:
+        renderer.err('Updated {} notes in the search index.\n'.format(n))
+    return index
 
-    success = False
-    for row in conn.execute('select id,mid,flds,tags,sfld from notes'):
-        tags = row['tags'].split()
-        card_ids, deck_id = get_card_ids(conn, row['id'], return_deck_id=True)
+def update_search_index(conn, args):
+    index = open_index(conn)
+    if not index:
+        return False
+    index.close()
+    return True
+
+# a pattern matching a whole word or a word prefix
+word_pattern_re = LazyPattern('word_pattern_re', r'(?:\^|\\b)(\w+)(\$|\\b)?')
+
+def get_index_query(regexps, only_tags=False):
+    """Translates the patterns that match words or word prefixes into a full
+    text query whose results include every note matching them. Returns None
+    if no pattern can be translated"""
+    terms = []
+    for regex in regexps:
+        m = word_pattern_re.fullmatch(regex)
+        if only_tags and not m:
+            terms += get_tag_terms(regex)
+            continue
+        if not m or not m.group(1).isalnum():
+            continue
+        word = m.group(1).lower()
+        whole_word = bool(m.group(2))
+        if not only_tags:
+            # ids are searched too, but aren't indexed (note that notes
+            # without cards are searched with the deck id 'None')
+            if word.isdigit() or (word == 'none' if whole_word
+                                  else 'none'.startswith(word)):
+                continue
+        term = '"{}"'.format(word)
+        if not whole_word:
+            term += '*'
+        if only_tags:
+            term = 'tags : '+term
+        terms.append(term)
+    if not terms:
+        return None
+    return ' AND '.join(terms)
+
+# a pattern matching a whole tag or a tag prefix
+tag_pattern_re = LazyPattern('tag_pattern_re', r'\^((?:[^\\.^$*+?{}\[\]|()]|\\[^0-9A-Za-z])+)(\$)?')
+
+# characters separating the words of the full text index
+word_separator_re = LazyPattern('word_separator_re', r'[\W_]+')
+
+def get_tag_terms(regex):
+    """Translates a pattern matching a whole tag or a tag prefix into full text
+    terms for the words any tag it matches contains, such as 'animal' and
+    'fish' for ^animal::fish$"""
+    m = tag_pattern_re.fullmatch(regex)
+    if not m:
+        return []
+    literal = escaped_char_re.sub(r'\1', m.group(1))
+    words = word_separator_re.split(literal)
+    terms = ['tags : "{}"'.format(word) for word in words if word]
+    # the last word may be the start of a longer one
+    if terms and not m.group(2) and words[-1]:
+        terms[-1] += '*'
+    return terms
+
+def get_tag_queries(regexps):
+    """Translates the patterns that match whole tags or tag prefixes into like
+    patterns for the tags table"""
+    queries = []
+    for regex in regexps:
+        m = tag_pattern_re.fullmatch(regex)
+        if not m:
+            continue
+        literal = escaped_char_re.sub(r'\1', m.group(1))
+        if m.group(2):
+            queries.append(like_pattern(literal, start='', end=''))
+        else:
+            queries.append(like_pattern(literal, start='', end='%'))
+    return queries
+
+def get_tagged_notes(index, tags):
+    """Returns the ids of the notes tagged with any of tags, ignoring case, in
+    order"""
+    import json
+    return [row[0] for row in index.execute(
+                'select distinct nid from tags where tag in '
+                '(select value from json_each(?)) order by nid',
+                (json.dumps(sorted(tags)),))]
+
+def search_index(conn, regexps, only_tags=False):
+    """Returns the ids of the notes that may match regexps according to the
+    search index, or None if the index can't narrow the search"""
+    query = get_index_query(regexps, only_tags=only_tags)
+    if only_tags:
+        # tags matching words are found faster through the full text index,
+        # so the tags table is only used for the other tag patterns
+        tag_queries = get_tag_queries(
+            [regex for regex in regexps
+             if not get_index_query([regex], only_tags=True)])
+    else:
+        tag_queries = []
+    if not query and not tag_queries:
+        return None
+    index = open_index(conn)
+    if not index:
+        return None
+
+    # every pattern must match: the first lookup finds the candidates, and
+    # the others only check them through the tags' index on nid
+    if query:
+        sql = 'select notes_fts.rowid from notes_fts where notes_fts match ?'
+        params = [query]
+        found = 'notes_fts.rowid'
+    else:
+        sql = ("select distinct tags.nid from tags "
+               "where tags.tag like ? escape '\\'")
+        params = tag_queries[:1]
+        tag_queries = tag_queries[1:]
+        found = 'tags.nid'
+    for pattern in tag_queries:
+        sql += (" and exists (select 1 from tags as other "
+                "where other.nid={} and other.tag like ? escape '\\')"
+                ).format(found)
+        params.append(pattern)
+    ids = [row[0] for row in index.execute(sql+' order by 1', params)]
+    index.close()
+    return ids
+
+# snapshots made by other versions are rebuilt from scratch
+snapshot_version = 2
+snapshot_magic = b'ANKISNAP'
+# columns of the snapshot's tables, in the order they are read, with the
+# string columns of notes kept in utf-8 buffers indexed by offsets
+snapshot_note_columns = ('id', 'mid')
+snapshot_note_strings = ('flds', 'tags', 'sfld')
+snapshot_card_columns = ('id', 'nid', 'did', 'ord', 'due', 'ivl', 'factor',
+                         'reps', 'lapses', 'queue')
+
+class SnapshotCardsMap(object):
+    """Maps note ids to card ids and deck ids like get_cards_map, reading them
+    from a snapshot instead of a dict"""
+    __slots__ = ('snapshot', 'next')
+
+    def __init__(self, snapshot):
+        self.snapshot = snapshot
+        self.next = 0
+
+    def get(self, note_id, default=None):
+        import bisect
+        nids = self.snapshot.card_nids
+        # notes are mostly looked up in order of id, so the next note's cards
+        # usually start where the last note's ended
+        first = self.next
+        if first >= len(nids) or nids[first] != note_id:
+            first = bisect.bisect_left(nids, note_id)
+        last = first
+        while last < len(nids) and nids[last] == note_id:
+            last += 1
+        self.next = last
+        if first == last:
+            return default
+        positions = self.snapshot.columns['cards.by_nid'][first:last]
+        ids = self.snapshot.columns['cards.id']
+        # the deck of the note's last card, as in get_cards_map
+        return ([ids[i] for i in positions],
+                self.snapshot.columns['cards.did'][positions[-1]])
+
+class Snapshot(object):
+    """Notes and cards of a collection kept in compact columns: integers in
+    arrays of 64 bit ints, and strings in utf-8 buffers with an array of
+    offsets, decoded only when read. Notes and cards are sorted by id, and
+    cards.by_nid lists the cards' positions sorted by note id and card id, so
+    rows are found with binary searches. Columns are arrays when the snapshot
+    was just built, and memoryviews of the mapped file when it was loaded"""
+
+    def __init__(self, columns):
+        self.columns = columns
+        self.card_nids = columns['cards.nid_sorted']
+
+    def string(self, column, i):
+        offsets = self.columns[column+'.offsets']
+        return str(self.columns[column][offsets[i]:offsets[i+1]], 'utf-8')
+
+    def position(self, table, _id):
+        import bisect
+        ids = self.columns[table+'.id']
+        i = bisect.bisect_left(ids, _id)
+        if i < len(ids) and ids[i] == _id:
+            return i
+        return None
+
+    def card_positions(self, note_id):
+        import bisect
+        first = bisect.bisect_left(self.card_nids, note_id)
+        last = bisect.bisect_right(self.card_nids, note_id, first)
+        return self.columns['cards.by_nid'][first:last]
+
+    def value(self, table, column, i):
+        if table == 'notes' and column in snapshot_note_strings:
+            return self.string('notes.'+column, i)
+        return self.columns[table+'.'+column][i]
+
+    def read_rows(self, table, columns, ids):
+        """Returns a dict mapping the ids found to rows of the id and columns,
+        a comma separated string, like read_rows_by_id's queries"""
+        columns = columns.split(',')
+        rows = dict()
+        for _id in ids:
+            i = self.position(table, _id)
+            if i is not None:
+                rows[_id] = tuple([_id]+[self.value(table, column, i)
+                                         for column in columns])
+        return rows
+
+    def note_rows(self, model_ids=None, deck_ids=None, note_ids=None):
+        """Yields (id, mid, flds, tags, sfld) rows for the notes in order of
+        id, optionally only those of some models, with cards in some decks,
+        or with some ids"""
+        columns = self.columns
+        ids = columns['notes.id']
+        mids = columns['notes.mid']
+        dids = columns['cards.did']
+        flds, flds_offsets = columns['notes.flds'], columns['notes.flds.offsets']
+        tags, tags_offsets = columns['notes.tags'], columns['notes.tags.offsets']
+        sflds, sfld_offsets = columns['notes.sfld'], columns['notes.sfld.offsets']
+        models = set(model_ids or [])
+        decks = set(deck_ids or [])
+        if note_ids is None:
+            positions = range(len(ids))
+        else:
+            positions = (self.position('notes', _id) for _id in note_ids)
+        for i in positions:
+            if i is None or (models and mids[i] not in models):
+                continue
+            if decks and not any(dids[j] in decks
+                                 for j in self.card_positions(ids[i])):
+                continue
+            j = i+1
+            yield (ids[i], mids[i],
+                   str(flds[flds_offsets[i]:flds_offsets[j]], 'utf-8'),
+                   str(tags[tags_offsets[i]:tags_offsets[j]], 'utf-8'),
+                   str(sflds[sfld_offsets[i]:sfld_offsets[j]], 'utf-8'))
+
+def build_snapshot(conn):
+    """Reads the notes and cards tables into the columns of a snapshot"""
+    import array
+    columns = dict()
+    for name in snapshot_note_columns:
+        columns['notes.'+name] = array.array('q')
+    buffers = dict()
+    for name in snapshot_note_strings:
+        buffers[name] = []
+        columns['notes.'+name+'.offsets'] = array.array('q', [0])
+    for row in conn.execute('select '+','.join(snapshot_note_columns+
+                                                snapshot_note_strings)+
+                            ' from notes order by id'):
+        for name, value in zip(snapshot_note_columns, row):
+            columns['notes.'+name].append(value)
+        for name, value in zip(snapshot_note_strings,
+                               row[len(snapshot_note_columns):]):
+            data = str(value).encode('utf-8')
+            buffers[name].append(data)
+            offsets = columns['notes.'+name+'.offsets']
+            offsets.append(offsets[-1]+len(data))
+    for name in snapshot_note_strings:
+        columns['notes.'+name] = b''.join(buffers[name])
+    buffers = None
+
+    for name in snapshot_card_columns:
+        columns['cards.'+name] = array.array('q')
+    for row in conn.execute('select '+','.join(snapshot_card_columns)+
+                            ' from cards order by id'):
+        for name, value in zip(snapshot_card_columns, row):
+            columns['cards.'+name].append(value)
+    nids = columns['cards.nid']
+    by_nid = sorted(range(len(nids)), key=nids.__getitem__)
+    columns['cards.by_nid'] = array.array('q', by_nid)
+    columns['cards.nid_sorted'] = array.array('q', (nids[i] for i in by_nid))
+    return columns
+
+def save_snapshot(path, key, columns):
+    """Writes the columns of a snapshot to a file: a header locating each
+    column, followed by the columns' raw bytes, each aligned to 8 bytes so it
+    can be cast back to an array of 64 bit ints once mapped"""
+    import array
+    import json
+    sections = dict()
+    offset = 0
+    for name in sorted(columns):
+        column = columns[name]
+        typecode = 'q' if isinstance(column, array.array) else 'B'
+        length = len(column)*(8 if typecode == 'q' else 1)
+        sections[name] = [offset, length, typecode]
+        offset += -(-length//8)*8
+    header = json.dumps({'version': snapshot_version, 'key': key,
+                         'byteorder': sys.byteorder,
+                         'sections': sections}).encode('utf-8')
+    header += b' '*(-len(header)%8)
+
+    temporary = path+'.tmp'
+    with open(temporary, 'wb') as f:
+        f.write(snapshot_magic)
+        f.write(len(header).to_bytes(8, 'little'))
+        f.write(header)
+        for name in sorted(columns):
+            data = bytes(columns[name])
+            f.write(data)
+            f.write(b'\0'*(-len(data)%8))
+    os.replace(temporary, path)
+
+def load_snapshot(path, key):
+    """Maps a snapshot's file in memory. Returns None if there's none, or if
+    it's outdated"""
+    import json
+    import mmap
+    try:
+        with open(path, 'rb') as f:
+            if f.read(8) != snapshot_magic:
+                return None
+            size = int.from_bytes(f.read(8), 'little')
+            header = json.loads(f.read(size).decode('utf-8'))
+            if (header.get('version') != snapshot_version or
+                header.get('key') != key or
+                header.get('byteorder') != sys.byteorder):
+                return None
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    except (OSError, ValueError):
+        return None
+
+    view = memoryview(data)
+    start = 16+size
+    columns = dict()
+    for name, (offset, length, typecode) in header['sections'].items():
+        column = view[start+offset:start+offset+length]
+        if typecode == 'q':
+            column = column.cast('q')
+        columns[name] = column
+    return Snapshot(columns)
+
+class CollectionCaches(object):
+    """Data read from a collection and kept between calls: its parsed models
+    and their layouts, its creation date and name indexes, and its snapshot"""
+
+    def __init__(self):
+        # the collection's modification time when refresh_caches last ran
+        self.mod = None
+        self.models = None
+        # model id -> ModelLayout
+        self.layouts = dict()
+        self.creation_date = None
+        # keyword -> NameIndex of the models or decks, and the collection's
+        # modification time when they were parsed
+        self.name_indexes = dict()
+        self.name_indexes_mod = None
+        self.snapshot = None
+
+# connection -> CollectionCaches, so programs using several collections don't
+# mix up their data
+collection_caches = dict()
+
+def get_caches(conn):
+    caches = collection_caches.get(conn)
+    if caches is None:
+        caches = CollectionCaches()
+        collection_caches[conn] = caches
+    return caches
+
+def drop_caches(conn):
+    """Forgets the caches of a connection, e.g. once it's closed"""
+    collection_caches.pop(conn, None)
+
+def get_snapshot(conn):
+    """Returns a snapshot of the collection when the --snapshot switch is used,
+    or None otherwise. The snapshot is mapped from the file next to the
+    collection (collection.anki_tool_snapshot), which is built again when
+    the collection was modified after it"""
+    if not use_snapshot:
+        return None
+    caches = get_caches(conn)
+    if caches.snapshot is None:
+        path = get_collection_path(conn)
+        if not path:
+            return None
+        key = get_file_key(path)
+        snapshot_path = os.path.splitext(path)[0]+'.anki_tool_snapshot'
+        snapshot = load_snapshot(snapshot_path, key)
+        if snapshot is None:
+            with phase('snapshot'):
+                columns = build_snapshot(conn)
+                try:
+                    save_snapshot(snapshot_path, key, columns)
+                    snapshot = load_snapshot(snapshot_path, key)
+                except OSError as e:
+                    renderer.err("Couldn't save snapshot: {}\n".format(e))
+                if snapshot is None:
+                    snapshot = Snapshot(columns)
+            if not quiet:
+                renderer.err('Built snapshot of {} notes\n'.format(
+                                 len(snapshot.columns['notes.id'])))
+        caches.snapshot = snapshot
+    return caches.snapshot
+
+def match_notes(conn, rows, matcher, cards_map, only_field=None,
+                only_tags=False, groups=False):
+    """Matches notes against matcher. rows are (id, mid, flds, tags, sfld)
+    tuples, and cards_map maps note ids to card ids and deck ids (see
+    get_cards_map). Yields (row, card ids, matched strings) for every matching
+    note, with matched strings being None unless groups is true"""
+    import re
+    if only_field:
+        field_regex = re.compile(only_field, re.I)
+        # model id -> indexes of the fields whose names match only_field
+        field_indexes = dict()
+    no_cards = ([], None)
+
+    for row in rows:
+        note_id, model_id, fieldsstr, tagsstr = row[0], row[1], row[2], row[3]
+        tags = tagsstr.split()
+        card_ids, deck_id = cards_map.get(note_id, no_cards)
         if not tags:
             tags = [''] # so ^$ will match
 
@@ -170,63 +1049,191 @@ def search_notes(conn, regexps, only_field=None, only_tags=False, cards=False):
         if only_tags:
             targets = tags
         elif only_field:
-            fields = create_fields_dict(conn, row['mid'], row['flds'])
-            targets = []
+            indexes = field_indexes.get(model_id)
+            if indexes is None:
+                indexes = []
+                for i, name in enumerate(get_layout(conn, model_id).names):
+                    if field_regex.search(name):
+                        indexes.append(i)
+                field_indexes[model_id] = indexes
             # choosing only fields matching the desired pattern
-            for key in fields.keys():
-                if re.search(only_field, key, re.I):
-                    targets.append(fields[key])
+            values = fieldsstr.split('\x1f')
+            targets = []
+            for i in indexes:
+                if i < len(values):
+                    targets.append(values[i])
+                else:
+                    targets.append('')
         else:
             # removing html tags
-            flds = re.sub('<[^>]*>', '', row['flds']).split('\x1f')
-            ids = [str(row['id']), str(row['mid'])]
+            flds = html_tag_re.sub('', fieldsstr).split('\x1f')
+            ids = [str(note_id), str(model_id)]
             for card_id in card_ids:
                 ids.append(str(card_id))
             ids.append(str(deck_id))
             targets = tags+ids+flds
 
-        # searching
-        groups = []
-        for regex in regexps:
-            found = False
-            # searching fields, tags and ids for pattern
-            for string in targets:
-                r = re.search(regex, string, re.I)
-                if r:
-                    groups.append(r.group())
-                    found = True
-            # if one pattern failed to match, don't bother with the rest
-            if not found:
-                break
+        # searching fields, tags and ids for the patterns
+        found = [] if groups else None
+        if matcher.match(targets, found):
+            yield row, card_ids, found
+
+def connect_read_only(path, factory=sqlite3.Connection):
+    """Opens a collection in read-only mode, so no write locks are taken even
+    while anki is running, tuned for scanning many rows: the file is mapped in
+    memory and the page cache is larger"""
+    # quoting only what sqlite would read as part of the uri, instead of
+    # importing urllib.parse for it
+    uri = path.replace('%', '%25').replace('?', '%3f').replace('#', '%23')
+    conn = sqlite3.connect('file:{}?mode=ro'.format(uri), uri=True,
+                           factory=factory)
+    conn.execute('pragma query_only=on')
+    conn.execute('pragma mmap_size=268435456')
+    conn.execute('pragma cache_size=-65536')
+    conn.execute('pragma temp_store=memory')
+    return conn
+
+def search_range(task):
+    """Searches the notes with ids in a range in a process of its own, with its
+    own read-only connection. Returns a list of matches, as yielded by
+    match_notes"""
+    (path, first, last, query, params, regexps, sensitive, only_field,
+     only_tags, need_cards, groups) = task
+    conn = connect_read_only(path)
+    if need_cards:
+        cards_map = get_cards_map(conn, note_range=(first, last))
+    else:
+        cards_map = dict()
+    rows = conn.execute(query, params+[first, last])
+    matcher = Matcher(regexps, case_sensitive=sensitive)
+    matches = list(match_notes(conn, rows, matcher, cards_map,
+                               only_field=only_field, only_tags=only_tags,
+                               groups=groups))
+    conn.close()
+    drop_caches(conn)
+    return matches
+
+def search_parallel(conn, path, query, params, regexps, only_field=None,
+                    only_tags=False, need_cards=False, groups=False,
+                    sensitive=False):
+    """Splits the notes into ranges of ids and searches them with a pool of
+    jobs processes. Yields the same matches as match_notes, in the same
+    order"""
+    ids = [row[0] for row in conn.execute('select id from notes order by id')]
+    if not ids:
+        return
+    # more ranges than processes, so a slow range doesn't hold the others
+    size = max(1, -(-len(ids)//(jobs*4)))
+    tasks = []
+    for i in range(0, len(ids), size):
+        last = ids[min(i+size, len(ids))-1]
+        tasks.append((path, ids[i], last, query, params, regexps,
+                      sensitive, only_field, only_tags, need_cards, groups))
+    import multiprocessing
+    with multiprocessing.Pool(jobs) as pool:
+        for matches in pool.imap(search_range, tasks):
+            for match in matches:
+                yield match
+
+def find_notes(conn, regexps, only_field=None, only_tags=False,
+               need_cards=True, groups=False, model_ids=None, deck_ids=None,
+               sensitive=None):
+    """Yields (row, card ids, matched strings) for every note matching all
+    regexps, as match_notes does, in order of note id. Card ids are only read
+    if need_cards is true, and matched strings only collected if groups is
+    true"""
+    if model_ids is None:
+        model_ids = search_models
+    if deck_ids is None:
+        deck_ids = search_decks
+    if sensitive is None:
+        sensitive = case_sensitive
+    matcher = Matcher(regexps, case_sensitive=sensitive)
+
+    # fields are indexed with their html stripped, so the index can't be used
+    # for searching raw fields
+    if use_index and not only_field:
+        note_ids = search_index(conn, regexps, only_tags=only_tags)
+    else:
+        note_ids = None
+    where, params = plan_search(regexps, only_field=only_field,
+                                only_tags=only_tags, model_ids=model_ids,
+                                deck_ids=deck_ids, note_ids=note_ids)
+    query = 'select id,mid,flds,tags,sfld from notes'+where
+
+    # the snapshot has no use for the prefilters, which only spare sqlite
+    # from reading rows
+    snapshot = get_snapshot(conn)
+    if snapshot:
+        rows = snapshot.note_rows(model_ids=model_ids, deck_ids=deck_ids,
+                                  note_ids=note_ids)
+        return match_notes(conn, rows, matcher, SnapshotCardsMap(snapshot),
+                           only_field=only_field, only_tags=only_tags,
+                           groups=groups)
+
+    path = get_collection_path(conn)
+    if jobs > 1 and path and not conn.in_transaction:
+        if where:
+            query += ' and id between ? and ? order by id'
+        else:
+            query += ' where id between ? and ? order by id'
+        return search_parallel(conn, path, query, params, regexps,
+                               only_field=only_field, only_tags=only_tags,
+                               need_cards=need_cards, groups=groups,
+                               sensitive=sensitive)
+
+    # all card ids are read at once
+    if need_cards:
+        cards_map = get_cards_map(conn)
+    else:
+        cards_map = dict()
+    rows = conn.execute(query+' order by id', params)
+    return match_notes(conn, rows, matcher, cards_map, only_field=only_field,
+                       only_tags=only_tags, groups=groups)
 
-        # found will only be true if all patterns matched something
-        if found:
-            # printing only the id to stdout, so output can be piped somewhere
-            if not human_readable:
+def search_notes(conn, regexps, only_field=None, only_tags=False, cards=False,
+                 model_ids=None, deck_ids=None):
+    if not regexps:
+        regexps = []
+        if not quiet:
+            print('Reading from stdin...', file=sys.stderr)
+        for regex in sys.stdin:
+            regexps.append(regex.rstrip())
+
+    # card ids are only needed when they are searched or printed
+    need_cards = cards or human_readable or not (only_tags or only_field)
+    groups = not (quiet or human_readable)
+    matches = find_notes(conn, regexps, only_field=only_field,
+                         only_tags=only_tags, need_cards=need_cards,
+                         groups=groups, model_ids=model_ids,
+                         deck_ids=deck_ids)
+
+    success = False
+    for row, card_ids, found in timed_iter('match', matches):
+        note_id, model_id, fieldsstr, tagsstr, sfld = row
+        # printing only the id to stdout, so output can be piped somewhere
+        if not human_readable:
+            with phase('write'):
                 if not quiet:
-                    print('Found ', ' and '.join(groups), ' in note ‘',
-                          row['sfld'], '’, ', sep='', end='', file=sys.stderr)
-                    if not cards:
-                        print('note id:', file=sys.stderr)
-                    else:
-                        print('card ids:', file=sys.stderr)
+                    renderer.err('Found {} in note ‘{}’, {}\n'.format(
+                                     ' and '.join(found), sfld,
+                                     'card ids:' if cards else 'note id:'))
                 if not cards:
-                    print(row['id'])
+                    renderer.out(str(note_id)+'\n')
                 else:
-                    for card_id in card_ids:
-                        print(card_id)
+                    renderer.out(''.join([str(card_id)+'\n'
+                                          for card_id in card_ids]))
+        else:
+            if not cards:
+                print_note(conn, note_id, model_id, fieldsstr, tagsstr, cards=card_ids)
             else:
-                if not cards:
-                    print_note(conn, row['id'], row['mid'], row['flds'], row['tags'], cards=card_ids)
-                else:
-                    print_cards(conn, card_ids)
-            success = True
+                print_cards(conn, card_ids)
+        success = True
     return success
 
 def search_notes_field(conn, regexps):
     if not regexps:
-        print('Usage: search_field field_regex regex [regex]...',
-              file=sys.stderr)
+        renderer.err('Usage: search_field field_regex regex [regex]...\n')
         return False
 
     field_regex = regexps[0]
@@ -235,8 +1242,7 @@ def search_notes_field(conn, regexps):
 
 def search_notes_fields(conn, regexps):
     if not regexps:
-        print('Usage: search_fields_only regex [regex]...',
-              file=sys.stderr)
+        renderer.err('Usage: search_fields_only regex [regex]...\n')
         return False
 
     return search_notes(conn, regexps, only_field='.')
@@ -247,56 +1253,170 @@ def search_notes_tags(conn, regexps):
 def search_cards(conn, regexps):
     return search_notes(conn, regexps, cards=True)
 
-models = None
+def normalize_field(value, sensitive=False):
+    """Reduces a field to what duplicate notes have in common: its text, with
+    html tags and entities removed and whitespace collapsed, case-folded
+    unless sensitive is true"""
+    value = html_to_text(value)
+    if '&' in value:
+        import html
+        value = html.unescape(value)
+    if not sensitive:
+        value = value.casefold()
+    return ' '.join(value.split())
+
+def find_duplicates(conn, field_regexps):
+    """Prints the ids of each group of notes whose fields are the same once
+    normalized, one group per line, in a single pass over the notes. Only
+    fields whose names match any of field_regexps are compared, if given"""
+    import re
+    import hashlib
+    field_res = [re.compile(regex, re.I) for regex in field_regexps]
+    where, params = plan_search([], model_ids=search_models,
+                                deck_ids=search_decks)
+    # the snapshot has no checksums
+    snapshot = None if csum_filter else get_snapshot(conn)
+    if snapshot:
+        rows = snapshot.note_rows(model_ids=search_models,
+                                  deck_ids=search_decks)
+    else:
+        # anki keeps a checksum of the first field of every note, so notes
+        # whose first field is unique can be left out by sqlite
+        if csum_filter:
+            where += ' and ' if where else ' where '
+            where += ('csum in (select csum from notes group by csum '
+                      'having count(*) > 1)')
+        rows = conn.execute('select id,mid,flds from notes'+where+
+                            ' order by id', params)
+
+    # model id -> indexes of the fields compared
+    field_indexes = dict()
+    # hash of the normalized fields -> id of the first note with them
+    first_notes = dict()
+    # hash -> ids of the notes with them, once a second note is found
+    groups = dict()
+    for row in timed_iter('match', rows):
+        note_id, model_id, fieldsstr = row[0], row[1], row[2]
+        indexes = field_indexes.get(model_id)
+        if indexes is None:
+            indexes = []
+            for i, name in enumerate(get_layout(conn, model_id).names):
+                if not field_res or any(r.search(name) for r in field_res):
+                    indexes.append(i)
+            field_indexes[model_id] = indexes
+        if not indexes:
+            continue
+        values = fieldsstr.split('\x1f')
+        key = '\x1f'.join([normalize_field(values[i], case_sensitive)
+                           if i < len(values) else '' for i in indexes])
+        # notes without anything in the compared fields aren't duplicates
+        if not key.strip('\x1f'):
+            continue
+        # hashes of 16 bytes take less memory than the fields, and colliding
+        # is far less likely than a corrupt collection
+        digest = hashlib.blake2b(key.encode('utf-8'), digest_size=16).digest()
+        first = first_notes.setdefault(digest, note_id)
+        if first != note_id:
+            group = groups.get(digest)
+            if group is None:
+                groups[digest] = [first, note_id]
+            else:
+                group.append(note_id)
+
+    duplicates = 0
+    for ids in sorted(groups.values()):
+        duplicates += len(ids)
+        with phase('write'):
+            if not human_readable:
+                renderer.out(' '.join([str(_id) for _id in ids])+'\n')
+            else:
+                if not quiet:
+                    renderer.err('### {} duplicate notes ###\n'
+                                 .format(len(ids)))
+                print_notes(conn, [str(_id) for _id in ids])
+    if not quiet:
+        renderer.err('Found {} groups of duplicates, with {} notes\n'
+                     .format(len(groups), duplicates))
+    return bool(groups)
+
 def read_models(conn):
-    global models
-    if not models:
+    """Returns the collection's models, mapping their ids as strings to their
+    json objects, parsed only once"""
+    import json
+    caches = get_caches(conn)
+    if not caches.models:
         row = conn.execute('select models from col where id=1').fetchone()
         if not row:
             raise Error("Couldn't read collection.")
         else:
-            models = json.loads(row['models'])
+            caches.models = json.loads(row[0])
+            caches.layouts.clear()
+    return caches.models
+
+class ModelLayout(object):
+    """A model's field names, with the indexes of its fields in the notes'
+    flds column in each of the orders they can be presented in"""
+    __slots__ = ('names', 'indexes', 'orders')
+
+    def __init__(self, model):
+        self.names = tuple(field['name'] for field in model['flds'])
+        self.indexes = dict((name, i) for i, name in enumerate(self.names))
+        # the 'Reverse' field is only presented when the note is presented
+        # as is, not when it's presented as one of its cards
+        everything = tuple(range(len(self.names)))
+        forward = tuple(i for i in everything if self.names[i] != 'Reverse')
+        # reverse -> (names, indexes)
+        self.orders = dict()
+        for reverse, indexes in ((None, everything), (False, forward),
+                                 (True, forward[::-1])):
+            self.orders[reverse] = (tuple(self.names[i] for i in indexes),
+                                    indexes)
+
+    def order(self, reverse=None):
+        """Returns the names and indexes of the fields in the order they
+        should be presented. reverse should be None if the note's fields
+        should be presented as is (including the 'Reverse' field), or True or
+        False if they should be presented reversed or not"""
+        return self.orders[bool(reverse) if reverse is not None else None]
+
+def get_layout(conn, model_id):
+    layouts = get_caches(conn).layouts
+    layout = layouts.get(model_id)
+    if layout is None:
+        layout = ModelLayout(read_models(conn)[str(model_id)])
+        layouts[model_id] = layout
+    return layout
+
+def get_field_names(conn, model_id):
+    return list(get_layout(conn, model_id).names)
+
+def get_fields(conn, model_id, fieldsstr, reverse=None):
+    """Returns lists with the names and values of a note's fields, in the
+    order they should be presented (see ModelLayout.order)"""
+    names, indexes = get_layout(conn, model_id).order(reverse)
+    values = fieldsstr.split('\x1f')
+    if len(values) >= len(indexes):
+        return list(names), [values[i] for i in indexes]
+    n = len(values)
+    return list(names), [values[i] if i < n else '' for i in indexes]
 
-collection_creation_date = None
 def get_collection_creation_date(conn):
-    global collection_creation_date
-    if not collection_creation_date:
+    import datetime
+    caches = get_caches(conn)
+    if not caches.creation_date:
         row = conn.execute('select crt from col where id=1').fetchone()
         if not row:
             raise Error("Couldn't read collection.")
         else:
             try:
-                collection_creation_date = datetime.datetime.fromtimestamp(row['crt']).date()
+                caches.creation_date = datetime.datetime.fromtimestamp(row[0]).date()
             except ValueError:
-                raise Error("Couldn't understand collection's creation date: {}".format(row['crt']))
-    return collection_creation_date
+                raise Error("Couldn't understand collection's creation date: {}".format(row[0]))
+    return caches.creation_date
 
 def create_fields_dict(conn, model_id, fieldsstr, reverse=None):
-    global models
-    if not models:
-        read_models(conn)
-    # creating fields dict
-    fields = collections.OrderedDict()
-    field_values = fieldsstr.split('\x1f')
-    i = 0
-    model_fields = models[str(model_id)]['flds']
-    # reverse will be None if the note's fields should be presented as is
-    # (including 'Reverse' field), or true or false if the fields should be
-    # presented reversed or not
-    # TODO: actually get regular and reversed layouts from model and print
-    # accordingly
-    if reverse:
-        model_fields.reverse()
-        field_values.reverse()
-    for i in range(len(model_fields)):
-        field = model_fields[i]
-        if reverse != None and field['name'] == 'Reverse':
-            continue
-        if field_values and (i < len(field_values)):
-            fields[field['name']] = field_values[i]
-        else:
-            fields[field['name']] = ''
-    return fields
+    names, values = get_fields(conn, model_id, fieldsstr, reverse=reverse)
+    return collections.OrderedDict(zip(names, values))
 
 # These two functions are needed to communicate ordered dicts through json.
 def ordered_dict_to_lists(dic):
@@ -316,27 +1436,49 @@ def lists_to_ordered_dict(keys, values):
     return r
 
 def print_fields(conn, note_id, model_id, fieldsstr, _json, print_notes=False, reverse=None):
-    fields = create_fields_dict(conn, model_id, fieldsstr, reverse=reverse)
+    names, values = get_fields(conn, model_id, fieldsstr, reverse=reverse)
     # printing results
     if not _json:
-        if not (quiet or print_notes):
-            if not reverse:
-                print('# Note {} #'.format(note_id), file=sys.stderr)
+        with phase('format'):
+            fields = [html_to_text(value) for value in values]
+        with phase('write'):
+            if quiet:
+                if fields:
+                    renderer.out('\n'.join(fields)+'\n')
             else:
-                print('# Note {} (reversed) #'.format(note_id), file=sys.stderr)
-        for name in fields:
-            # Strip html, replace </div> and <br>s with line breaks, since
-            # that's how anki handles line breaks in fields
-            field = re.sub('</div>|<br[^>]*>', '\n', fields[name]).rstrip()
-            field = re.sub('<[^>]*>', '', field)
-            if not quiet:
-                print('## {} ##'.format(name), file=sys.stderr)
-            print(field)
-        if not print_notes:
-            print()
+                if not print_notes:
+                    if not reverse:
+                        renderer.err('# Note {} #\n'.format(note_id))
+                    else:
+                        renderer.err('# Note {} (reversed) #\n'.format(note_id))
+                for name, field in zip(names, fields):
+                    renderer.err('## '+name+' ##\n')
+                    renderer.out(field+'\n')
+            if not print_notes:
+                renderer.out('\n')
         return None
     else:
-        return ordered_dict_to_lists(fields)
+        return names, values
+
+def dump_record(records, key, value):
+    """Adds a record to be dumped as a single json object, or, in the ndjson
+    format, prints it right away as an object of its own"""
+    import json
+    if output_format == 'ndjson':
+        with phase('format'):
+            line = json.dumps({key: value})
+        with phase('write'):
+            renderer.out(line+'\n')
+    else:
+        records[key] = value
+
+def dump_records(records):
+    import json
+    if output_format != 'ndjson':
+        with phase('format'):
+            dump = json.dumps(records)
+        with phase('write'):
+            renderer.out(dump+'\n')
 
 def print_notes_fields(conn, ids, _json=False):
     notes = dict()
@@ -345,92 +1487,229 @@ def print_notes_fields(conn, ids, _json=False):
         if not quiet:
             print('Reading from stdin...', file=sys.stderr)
         ids = sys.stdin
-    for _id in ids:
-        _id = _id.rstrip()
-        row = conn.execute('select mid,flds from notes where id=?',
-                           (_id,)).fetchone()
-        if not row:
-            if not quiet:
-                print('Note with id', _id, 'not found, skipping',
-                      file=sys.stderr)
-        else:
-            success = True
-            notes[_id] = print_fields(conn, _id, row['mid'], row['flds'],
+    ids = (_id.rstrip() for _id in ids)
+    for chunk in read_rows_by_id(conn, 'notes', 'mid,flds', ids):
+        for _id, row in chunk:
+            if not row:
+                if not quiet:
+                    renderer.err('Note with id {} not found, skipping\n'
+                                 .format(_id))
+            else:
+                success = True
+                _, model_id, fieldsstr = row
+                fields = print_fields(conn, _id, model_id, fieldsstr,
                                       _json=_json)
-                
+                if _json:
+                    dump_record(notes, _id, fields)
+
     if _json:
-        print(json.dumps(notes))
+        dump_records(notes)
     return success
 
 def dump_notes_fields(conn, ids):
-    print_notes_fields(conn, ids, _json=True)
-
-def replace_fields(conn, json_strings):
-    total = 0
+    return print_notes_fields(conn, ids, _json=True)
+
+# number of notes modified with a single executemany by NotesWriter
+batch_size = 1000
+
+class NotesWriter(object):
+    """Updates columns of many notes in batches of batch_size, with a single
+    executemany and modification time per batch. Each batch runs inside its
+    own savepoint: if it fails, it is rolled back and retried one note at a
+    time, so the notes causing the failure can be reported and skipped
+    without losing the rest"""
+
+    def __init__(self, conn, columns, size=None):
+        self.conn = conn
+        self.statement = 'update notes set {}=?,mod=?,usn=? where id=?'.format(
+                             '=?,'.join(columns))
+        self.size = size or batch_size
+        self.pending = []
+        self.written = 0
+        self.failed = 0
+
+    def add(self, note_id, *values):
+        self.pending.append(values+(note_id,))
+        if len(self.pending) >= self.size:
+            self.flush()
+
+    def flush(self):
+        if not self.pending:
+            return
+        mod = int(time.time())
+        rows = [values[:-1]+(mod, -1, values[-1]) for values in self.pending]
+        self.pending = []
+
+        # savepoints outside a transaction would commit when released
+        if not self.conn.in_transaction:
+            self.conn.execute('begin')
+        self.conn.execute('savepoint notes_writer')
+        try:
+            with phase('update'):
+                self.conn.executemany(self.statement, rows)
+            self.written += len(rows)
+        except sqlite3.Error:
+            self.conn.execute('rollback to notes_writer')
+            for row in rows:
+                try:
+                    self.conn.execute(self.statement, row)
+                    self.written += 1
+                except sqlite3.Error as e:
+                    renderer.err("Couldn't modify note {}, skipping: {}\n"
+                                 .format(row[-1], e))
+                    self.failed += 1
+        self.conn.execute('release notes_writer')
+
+def replace_notes_column(conn, json_strings, column, to_value):
+    """Sets column in every note from json strings mapping note ids to values.
+    to_value converts each value to the column's contents, raising ValueError
+    if it's malformed. Malformed notes are reported and skipped"""
+    import json
     if not json_strings:
         if not quiet:
             print('Reading from stdin...', file=sys.stderr)
         json_strings= sys.stdin
+    writer = NotesWriter(conn, [column])
+    failed = 0
     for string in json_strings:
-        notes = json.loads(string.rstrip())
-        if type(notes) != dict:
-            print('Malformed string, aborting:', string, file=sys.stderr)
-            return False
+        try:
+            with phase('parse'):
+                notes = json.loads(string.rstrip())
+            if type(notes) != dict:
+                raise ValueError
+        except ValueError:
+            renderer.err('Malformed string, skipping: '+string+'\n')
+            failed += 1
+            continue
         for _id in notes:
-            note = notes[_id]
-            if len(note) != 2 or type(note[0]) != list or type(note[1]) != list:
-                print('Malformed string, aborting:', string, file=sys.stderr)
-                return False
-            fieldsstr = '\x1f'.join(note[1])
-            conn.execute('update notes set flds=?,mod=?,usn=? where id=?',
-                           (fieldsstr, int(time.time()), -1, _id))
-            total += 1
+            try:
+                value = to_value(notes[_id])
+            except (ValueError, TypeError, AttributeError):
+                renderer.err('Malformed note {}, skipping: {}\n'.format(
+                                 _id, notes[_id]))
+                failed += 1
+                continue
+            writer.add(_id, value)
+    writer.flush()
+
+    total = writer.written
+    failed += writer.failed
     if total > 0:
-        print(total, 'notes successfully modified')
+        renderer.out('{} notes successfully modified\n'.format(total))
     elif not quiet:
-        print('No notes were modified', file=sys.stderr)
+        renderer.err('No notes were modified\n')
+    if failed > 0:
+        renderer.err('{} notes or strings were malformed or could not be '
+                     'modified\n'.format(failed))
     return (total > 0)
 
+def fields_value(note):
+    if len(note) != 2 or type(note[0]) != list or type(note[1]) != list:
+        raise ValueError
+    return '\x1f'.join(note[1])
+
+def replace_fields(conn, json_strings):
+    return replace_notes_column(conn, json_strings, 'flds', fields_value)
+
+class NameIndex(object):
+    """Names and ids of a collection's models or decks, with the names sorted
+    in lowercase so exact and prefix lookups are binary searches"""
+    __slots__ = ('names', 'keys', 'ids')
+
+    def __init__(self, entries):
+        # id -> name, in the collection's order
+        self.names = collections.OrderedDict()
+        for key, entry in entries.items():
+            self.names[int(key)] = entry['name']
+        pairs = sorted((name.lower(), _id) for _id, name in self.names.items())
+        self.keys = [key for key, _ in pairs]
+        self.ids = [_id for _, _id in pairs]
+
+    def exact(self, name):
+        """Returns the ids of the entries named name, ignoring case"""
+        import bisect
+        key = name.lower()
+        first = bisect.bisect_left(self.keys, key)
+        last = bisect.bisect_right(self.keys, key, first)
+        return self.ids[first:last]
+
+    def prefix(self, prefix):
+        """Returns the ids of the entries whose names start with prefix,
+        ignoring case"""
+        import bisect
+        key = prefix.lower()
+        first = bisect.bisect_left(self.keys, key)
+        last = first
+        while last < len(self.keys) and self.keys[last].startswith(key):
+            last += 1
+        return self.ids[first:last]
+
+def get_name_index(conn, keyword):
+    """Returns the NameIndex of the collection's models or decks, parsing
+    their json only when the collection was modified since the last call"""
+    import json
+    caches = get_caches(conn)
+    mod = conn.execute('select mod from col where id=1').fetchone()[0]
+    if mod != caches.name_indexes_mod:
+        caches.name_indexes.clear()
+        caches.name_indexes_mod = mod
+    index = caches.name_indexes.get(keyword)
+    if index is None:
+        row = conn.execute('select '+keyword+' from col where id=1').fetchone()
+        index = NameIndex(json.loads(row[0]))
+        caches.name_indexes[keyword] = index
+    return index
+
+def resolve_names(conn, keyword, values):
+    """Converts model or deck names given with -m or -d to ids. Ids are kept
+    as they are, names ending with * select every name starting with them,
+    and deck names also select their subdecks. Raises ValueError for names
+    matching nothing"""
+    ids = []
+    for value in values:
+        if value.isdigit():
+            ids.append(int(value))
+            continue
+        index = get_name_index(conn, keyword)
+        if value.endswith('*'):
+            found = index.prefix(value[:-1])
+        else:
+            found = index.exact(value)
+            if keyword == 'decks':
+                found = found+index.prefix(value+'::')
+        if not found:
+            raise ValueError('no {} named ‘{}’'.format(keyword[:-1], value))
+        ids += found
+    return ids
+
 def list_models_decks(conn, regexs, keyword):
+    import re
     if keyword not in ['models', 'decks']:
         raise ValueError('Keyword should be either models or decks: '+keyword)
 
     if not regexs:
         if not quiet:
-            print('Listing all ', keyword, '.', sep='', file=sys.stderr)
+            renderer.err('Listing all {}.\n'.format(keyword))
         regexs = ['.']
 
-    row = conn.execute("select "+keyword+" from col where id=1").fetchone()
-    if not row:
-        print("Couldn't read collection.")
-        return False
-
     try:
-        dic = json.loads(row[keyword])
-        if type(dic) != dict:
-            raise ValueError
-    except ValueError:
-        print("Couldn't decode", keyword, "string:", row[keyword],
-              file=sys.stderr)
-        return False
-    except IndexError:
-        print("Couldn't find column", keyword, ":", row.keys(),
-              file=sys.stderr)
+        index = get_name_index(conn, keyword)
+    except (ValueError, TypeError, AttributeError, KeyError):
+        renderer.err("Couldn't decode {} string\n".format(keyword))
         return False
 
-    for key in dic:
+    regexs = [re.compile(regex, re.I) for regex in regexs]
+    for _id, name in index.names.items():
+        key = str(_id)
         matches = True
         for regex in regexs:
-            if (
-                not re.search(regex, dic[key]['name'], re.I) and
-                not re.search(regex, key, re.I)
-               ):
+            if not regex.search(name) and not regex.search(key):
                 matches = False
                 break
         if matches:
             if not quiet:
-                print('# {} #'.format(dic[key]['name']), file=sys.stderr)
-            print(key)
+                renderer.err('# {} #\n'.format(name))
+            renderer.out(key+'\n')
     return True
 
 def list_models(conn, regexs):
@@ -441,9 +1720,10 @@ def list_decks(conn, regexs):
 
 def print_tags(conn, note_id, tagsstr, print_notes=False):
     # printing results
-    if not (quiet or print_notes):
-        print('# Note {} #'.format(note_id), file=sys.stderr)
-    print(tagsstr.strip())
+    with phase('write'):
+        if not (quiet or print_notes):
+            renderer.err('# Note {} #\n'.format(note_id))
+        renderer.out(tagsstr.strip()+'\n')
 
 def print_notes_tags(conn, ids, _json=False):
     notes = dict()
@@ -452,70 +1732,429 @@ def print_notes_tags(conn, ids, _json=False):
         if not quiet:
             print('Reading from stdin...', file=sys.stderr)
         ids = sys.stdin
-    for _id in ids:
-        _id = _id.rstrip()
-        row = conn.execute('select tags from notes where id=?',
-                           (_id,)).fetchone()
-        if not row:
-            if not quiet:
-                print('Note with id', _id, 'not found, skipping',
-                      file=sys.stderr)
-        else:
-            success = True
-            if _json:
-                notes[_id] = row['tags']
+    ids = (_id.rstrip() for _id in ids)
+    for chunk in read_rows_by_id(conn, 'notes', 'tags', ids):
+        for _id, row in chunk:
+            if not row:
+                if not quiet:
+                    renderer.err('Note with id {} not found, skipping\n'
+                                 .format(_id))
             else:
-                print_tags(conn, _id, row['tags'])
-                
+                success = True
+                if _json:
+                    dump_record(notes, _id, row[1])
+                else:
+                    print_tags(conn, _id, row[1])
+
     if _json:
-        print(json.dumps(notes))
+        dump_records(notes)
     return success
 
 def dump_notes_tags(conn, ids):
-    print_notes_tags(conn, ids, _json=True)
+    return print_notes_tags(conn, ids, _json=True)
+
+def tags_value(tagsstr):
+    tags = tagsstr.strip().split(' ')
+    if not tags:
+        return ''
+    return ' {} '.format(' '.join(tags))
 
 def replace_tags(conn, json_strings):
-    total = 0
-    if not json_strings:
+    return replace_notes_column(conn, json_strings, 'tags', tags_value)
+
+# images in fields, whose file names anki keeps when stripping html
+media_re = LazyPattern('media_re', r'(?i)<img[^>]+src=["\']?([^"\'>]+)["\']?[^>]*>')
+# field references in card templates, with the kind of section they open
+template_field_re = LazyPattern('template_field_re', r'{{([#^/]?)([^}]*)}}')
+# cloze deletions, each number being one of the note's cards
+cloze_re = LazyPattern('cloze_re', r'{{c(\d+)::')
+# characters of the guids anki gives notes
+guid_chars = ('abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789'
+              '!#$%&()*+,-./:;<=>?@[]^_`{|}~')
+
+def strip_html_media(value):
+    """Strips html from a field as anki does for the sort field and the
+    checksum of the first field, keeping the file names of images"""
+    if '<' in value:
+        value = html_tag_re.sub('', media_re.sub(r' \1 ', value))
+    if '&' in value:
+        import html
+        value = html.unescape(value)
+    return value
+
+def field_checksum(value):
+    """Returns the checksum anki keeps of the first field of notes, to find
+    duplicates"""
+    import hashlib
+    digest = hashlib.sha1(strip_html_media(value).encode('utf-8')).hexdigest()
+    return int(digest[:8], 16)
+
+guid_pairs = None
+def guid64():
+    """Returns a random guid for a new note, encoded as anki encodes them"""
+    global guid_pairs
+    if not guid_pairs:
+        # encoding two characters at a time takes half the divisions
+        guid_pairs = [a+b for a in guid_chars for b in guid_chars]
+    n = int.from_bytes(os.urandom(8), 'big')
+    pairs = []
+    while n:
+        n, i = divmod(n, len(guid_pairs))
+        pairs.append(guid_pairs[i])
+    # a leading character encoding zero would not be there one at a time
+    return ''.join(reversed(pairs)).lstrip(guid_chars[0])
+
+def parse_templates(model):
+    """Returns a list of (ordinal, deck id, required fields, fields) tuples
+    for each of a model's templates, with the fields inside conditional
+    sections of the question and all fields it shows"""
+    templates = []
+    for template in model['tmpls']:
+        required = set()
+        shown = set()
+        for kind, name in template_field_re.findall(template['qfmt']):
+            # removing filters, such as type: or cloze:
+            name = name.split(':')[-1].strip()
+            if kind == '#':
+                required.add(name)
+            elif not kind:
+                shown.add(name)
+        templates.append((template['ord'], template.get('did'), required,
+                          shown))
+    return templates
+
+def card_ordinals(model, templates, values):
+    """Returns the ordinals of the cards anki generates for a note of model,
+    with templates as parse_templates returns them: one per cloze number in
+    cloze models, and otherwise one per template whose question shows a
+    non-empty field, outside of empty conditional sections"""
+    if model.get('type') == 1:
+        numbers = set()
+        for value in values:
+            numbers.update(int(n) for n in cloze_re.findall(value))
+        return sorted(n-1 for n in numbers if n > 0) or [0]
+    filled = set(field['name'] for field, value in zip(model['flds'], values)
+                 if html_to_text(value).strip())
+    return [ordinal for ordinal, _, required, shown in templates
+            if required <= filled and shown & filled]
+
+def read_records(lines):
+    """Yields the notes to add from lines of json objects or, with
+    --input-format csv, csv rows of model, deck, tags and fields, as (line,
+    dict) pairs. Malformed lines are yielded with None"""
+    import json
+    if input_format == 'csv':
+        import csv
+        for row in csv.reader(lines):
+            if len(row) < 4:
+                yield ','.join(row), None
+                continue
+            yield ','.join(row), {'model': row[0], 'deck': row[1],
+                                  'tags': row[2], 'fields': row[3:]}
+        return
+    for line in lines:
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            record = json.loads(line)
+        except ValueError:
+            record = None
+        yield line, (record if type(record) == dict else None)
+
+def find_model_deck(conn, keyword, name):
+    """Returns the id of the model or deck (depending on keyword) with the
+    given name or id, raising ValueError if there's none"""
+    index = get_name_index(conn, keyword)
+    if name.isdigit() and int(name) in index.names:
+        return int(name)
+    found = index.exact(name)
+    if not found:
+        raise ValueError('no {} named ‘{}’'.format(keyword[:-1], name))
+    return found[0]
+
+def parse_record(conn, record, ids):
+    """Returns the model, deck id, field values and tags of a note to add,
+    raising ValueError if it's malformed or its model or deck don't exist.
+    ids caches the ids of the models and decks found, by keyword and name"""
+    models = read_models(conn)
+    name = str(record.get('model', ''))
+    model_id = ids.get(('models', name))
+    if model_id is None:
+        model_id = find_model_deck(conn, 'models', name)
+        ids['models', name] = model_id
+    model = models[str(model_id)]
+
+    deck_id = None
+    name = str(record.get('deck') or '')
+    if name:
+        deck_id = ids.get(('decks', name))
+        if deck_id is None:
+            deck_id = find_model_deck(conn, 'decks', name)
+            ids['decks', name] = deck_id
+
+    names = get_layout(conn, model['id']).names
+    fields = record.get('fields')
+    if type(fields) == dict:
+        unknown = set(fields)-set(names)
+        if unknown:
+            raise ValueError('no field named ‘{}’ in model ‘{}’'.format(
+                                 unknown.pop(), model['name']))
+        values = [fields.get(name, '') for name in names]
+    elif type(fields) == list and len(fields) <= len(names):
+        values = fields+['']*(len(names)-len(fields))
+    else:
+        raise ValueError('fields should be a list of at most {} values, or '
+                         'an object'.format(len(names)))
+    values = [str(value) for value in values]
+
+    tags = record.get('tags') or []
+    if type(tags) != list:
+        tags = str(tags).split()
+    return model, deck_id, values, [str(tag) for tag in tags]
+
+def add_notes(conn, records):
+    """Adds notes from json objects or csv rows (see read_records), and their
+    cards, as new cards. Prints the ids of the notes added"""
+    import json
+    if not records:
         if not quiet:
             print('Reading from stdin...', file=sys.stderr)
-        json_strings= sys.stdin
-    for string in json_strings:
-        notes = json.loads(string.rstrip())
-        if type(notes) != dict:
-            print('Malformed string, aborting:', string, file=sys.stderr)
-            return False
-        for _id in notes:
-            tags = notes[_id].strip().split(' ')
-            if not tags:
-                tagsstr = ''
-            else:
-                tagsstr = ' {} '.format(' '.join(tags))
-            conn.execute('update notes set tags=?,mod=?,usn=? where id=?',
-                           (tagsstr, int(time.time()), -1, _id))
-            total += 1
-    if total > 0:
-        print(total, 'notes successfully modified')
+        records = sys.stdin
+
+    # ids are creation times in milliseconds, so new ones follow the newest
+    # note or card, or now, and are unique even when adding many per second
+    now = int(time.time()*1000)
+    max_id = conn.execute('select max(id) from notes').fetchone()[0] or 0
+    note_id = max(now, max_id+1)
+    max_id = conn.execute('select max(id) from cards').fetchone()[0] or 0
+    card_id = max(now, max_id+1)
+    row = conn.execute('select conf,tags from col where id=1').fetchone()
+    if not row:
+        renderer.err("Couldn't read collection.\n")
+        return False
+    conf = json.loads(row[0])
+    col_tags = json.loads(row[1])
+    # new cards are due in the order they were added
+    position = conf.get('nextPos', 1)
+
+    # model id -> parsed templates
+    templates = dict()
+    # (keyword, name) -> id of the models and decks of the notes
+    ids = dict()
+    notes = []
+    cards = []
+    added = 0
+    added_cards = 0
+    failed = 0
+    mod = int(time.time())
+    try:
+        for line, record in timed_iter('parse', read_records(records)):
+            try:
+                if record is None:
+                    raise ValueError('malformed record')
+                model, deck_id, values, tags = parse_record(conn, record, ids)
+            except (ValueError, KeyError) as e:
+                renderer.err('Malformed note, skipping ({}): {}\n'.format(
+                                 e, line))
+                failed += 1
+                continue
+            model_templates = templates.get(model['id'])
+            if model_templates is None:
+                model_templates = parse_templates(model)
+                templates[model['id']] = model_templates
+            ordinals = card_ordinals(model, model_templates, values)
+            if not ordinals:
+                renderer.err('Note would have no cards, skipping: {}\n'
+                             .format(line))
+                failed += 1
+                continue
+
+            for tag in tags:
+                if tag not in col_tags:
+                    col_tags[tag] = -1
+            sort_field = strip_html_media(values[model.get('sortf', 0)])
+            csum = field_checksum(values[0])
+            notes.append((note_id, guid64(), model['id'], mod, -1,
+                          ' {} '.format(' '.join(tags)) if tags else '',
+                          '\x1f'.join(values), sort_field, csum, 0, ''))
+            cloze = model.get('type') == 1
+            for ordinal in ordinals:
+                # templates may send their cards to a deck of their own, and
+                # cloze models have a single template for all their cards
+                template_deck = model_templates[0 if cloze else ordinal][1]
+                did = template_deck or deck_id or model.get('did') or 1
+                cards.append((card_id, note_id, did, ordinal, mod, -1, 0, 0,
+                              position, 0, 0, 0, 0, 0, 0, 0, 0, ''))
+                card_id += 1
+            note_id += 1
+            position += 1
+
+            if len(notes) >= batch_size:
+                added += len(notes)
+                added_cards += len(cards)
+                insert_notes(conn, notes, cards)
+                notes = []
+                cards = []
+        added += len(notes)
+        added_cards += len(cards)
+        insert_notes(conn, notes, cards)
+
+        if added:
+            conf['nextPos'] = position
+            conn.execute('update col set conf=?,tags=?,mod=? where id=1',
+                         (json.dumps(conf), json.dumps(col_tags),
+                          int(time.time()*1000)))
+    except sqlite3.Error as e:
+        renderer.err("Error: couldn't add notes: {}\n".format(e))
+        return False
+
+    if added > 0:
+        if not quiet:
+            renderer.err('{} notes added, with {} cards\n'.format(
+                             added, added_cards))
     elif not quiet:
-        print('No notes were modified', file=sys.stderr)
-    return (total > 0)
+        renderer.err('No notes were added\n')
+    if failed > 0:
+        renderer.err('{} notes were malformed or had no cards\n'.format(failed))
+    return added > 0
+
+def insert_notes(conn, notes, cards):
+    """Inserts rows of new notes and cards with all their columns, then
+    prints the ids of the notes once they're committed"""
+    if not notes:
+        return
+    with phase('insert'):
+        conn.executemany('insert into notes values (?,?,?,?,?,?,?,?,?,?,?)',
+                         notes)
+        conn.executemany('insert into cards values '
+                         '(?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)', cards)
+    out_committed(''.join(str(note[0])+'\n' for note in notes))
+
+class Note(object):
+    """A note read by select_notes or read_notes. Its fields are read and set
+    by name, as in note['Front'], with their html, and its tags are a list.
+    The fields are only split when first used"""
+    __slots__ = ('id', 'model_id', 'layout', 'tags', 'flds', 'tagsstr',
+                 '_values')
+
+    def __init__(self, conn, note_id, model_id, fieldsstr, tagsstr):
+        self.id = note_id
+        self.model_id = model_id
+        self.layout = get_layout(conn, model_id)
+        self.tags = tagsstr.split()
+        # as read, so write_notes can tell whether the note was changed
+        self.flds = fieldsstr
+        self.tagsstr = tagsstr
+        self._values = None
+
+    @property
+    def values(self):
+        """The list of the note's field values, in the order of its model's
+        fields"""
+        if self._values is None:
+            values = self.flds.split('\x1f')
+            missing = len(self.layout.names)-len(values)
+            if missing > 0:
+                values += ['']*missing
+            self._values = values
+        return self._values
+
+    def keys(self):
+        return self.layout.names
+
+    def fields(self):
+        """Returns an OrderedDict of the note's field names and values"""
+        return collections.OrderedDict(zip(self.layout.names, self.values))
+
+    def get(self, name, default=None):
+        i = self.layout.indexes.get(name)
+        if i is None:
+            return default
+        return self.values[i]
+
+    def __getitem__(self, name):
+        return self.values[self.layout.indexes[name]]
+
+    def __setitem__(self, name, value):
+        self.values[self.layout.indexes[name]] = value
+
+    def __contains__(self, name):
+        return name in self.layout.indexes
+
+    def __repr__(self):
+        return 'Note({}, {!r}, {!r})'.format(self.id, self.fields(), self.tags)
+
+def select_notes(conn, regexps=(), only_field=None, only_tags=False,
+                 model_ids=None, deck_ids=None, case_sensitive=None):
+    """Yields a Note for every note matching all regexps, as searched by the
+    search commands, or for every note if there are none, in order of id"""
+    for row, _, _ in find_notes(conn, regexps, only_field=only_field,
+                                only_tags=only_tags, need_cards=False,
+                                model_ids=model_ids, deck_ids=deck_ids,
+                                sensitive=case_sensitive):
+        yield Note(conn, row[0], row[1], row[2], row[3])
+
+def read_notes(conn, ids):
+    """Yields a Note for each of the notes with ids found, such as the ids
+    printed by searches, reading them in chunks"""
+    for chunk in read_rows_by_id(conn, 'notes', 'mid,flds,tags', ids):
+        for _, row in chunk:
+            if row:
+                yield Note(conn, row[0], row[1], row[2], row[3])
+
+def transform_notes(notes, *transforms):
+    """Yields notes after calling each of transforms with them, in order.
+    Transforms modify notes in place, and drop them from the stages that
+    follow by returning False"""
+    for note in notes:
+        for transform in transforms:
+            if transform(note) is False:
+                break
+        else:
+            yield note
+
+def write_notes(conn, notes, size=None):
+    """Writes the notes whose fields or tags were changed since they were
+    read in batches of size (by default, batch_size, set with -b), updating
+    their sort field and checksum. Returns the number of notes modified. As
+    with the rest of the module's functions, the caller commits the changes"""
+    models = read_models(conn)
+    writer = NotesWriter(conn, ['flds', 'tags', 'sfld', 'csum'], size)
+    for note in notes:
+        if note._values is not None:
+            fieldsstr = '\x1f'.join(note._values)
+        else:
+            fieldsstr = note.flds
+        if note.tags != note.tagsstr.split():
+            tagsstr = ' {} '.format(' '.join(note.tags)) if note.tags else ''
+        else:
+            tagsstr = note.tagsstr
+        if fieldsstr == note.flds and tagsstr == note.tagsstr:
+            continue
+        values = note.values
+        sort_field = models[str(note.model_id)].get('sortf', 0)
+        writer.add(note.id, fieldsstr, tagsstr,
+                   strip_html_media(values[sort_field]),
+                   field_checksum(values[0]))
+    writer.flush()
+    return writer.written
 
 def print_note(conn, note_id, model_id, fields_str, tags_str, cards=None, reverse=None):
     if not quiet:
         if not reverse:
-            print('# Note {} #'.format(note_id), file=sys.stderr)
+            renderer.err('# Note {} #\n'.format(note_id))
         else:
-            print('# Note {} (reversed) #'.format(note_id), file=sys.stderr)
+            renderer.err('# Note {} (reversed) #\n'.format(note_id))
     print_fields(conn, note_id, model_id, fields_str, _json=False, print_notes=True, reverse=reverse)
     if not quiet:
-        print('## Tags ##', file=sys.stderr)
+        renderer.err('## Tags ##\n')
     print_tags(conn, note_id, tags_str, print_notes=True)
     if cards:
         if not quiet:
-            print('## Cards ##', file=sys.stderr)
-        for card_id in cards:
-            print(card_id)
-    print()
+            renderer.err('## Cards ##\n')
+        renderer.out(''.join([str(card_id)+'\n' for card_id in cards]))
+    renderer.out('\n')
 
 def print_notes(conn, ids, _json=False):
     success = False
@@ -524,28 +2163,30 @@ def print_notes(conn, ids, _json=False):
         if not quiet:
             print('Reading from stdin...', file=sys.stderr)
         ids = sys.stdin
-    for _id in ids:
-        _id = _id.rstrip()
-        row = conn.execute('select mid,flds,tags from notes where id=?',
-                           (_id,)).fetchone()
-        if not row:
-            if not quiet:
-                print('Note with id', _id, 'not found, skipping',
-                      file=sys.stderr)
-        else:
+    ids = (_id.rstrip() for _id in ids)
+    no_cards = ([], None)
+    for chunk in read_rows_by_id(conn, 'notes', 'mid,flds,tags', ids):
+        cards_map = get_cards_map(conn, [row[0] for _, row in chunk if row])
+        for _id, row in chunk:
+            if not row:
+                if not quiet:
+                    renderer.err('Note with id {} not found, skipping\n'
+                                 .format(_id))
+                continue
             success = True
+            note_id, model_id, fieldsstr, tagsstr = row
+            card_ids = cards_map.get(note_id, no_cards)[0]
             if not _json:
-                print_note(conn, _id, row['mid'], row['flds'], row['tags'], cards=get_card_ids(conn, _id))
+                print_note(conn, _id, model_id, fieldsstr, tagsstr, cards=card_ids)
             else:
-                fields = create_fields_dict(conn, row['mid'], row['flds'], reverse=False)
-                notes[_id] = {
-                        'model_id' : row['mid'],
-                        'fields' : ordered_dict_to_lists(fields),
-                        'tags' : row['tags'],
-                        'cards' : get_card_ids(conn, _id),
-                        }
+                dump_record(notes, _id, {
+                        'model_id' : model_id,
+                        'fields' : get_fields(conn, model_id, fieldsstr, reverse=False),
+                        'tags' : tagsstr,
+                        'cards' : card_ids,
+                        })
     if _json:
-        print(json.dumps(notes))
+        dump_records(notes)
     return success
 
 def dump_notes(conn, ids):
@@ -580,39 +2221,41 @@ def prompt_confirmation():
         return True
     return False
 
-def print_card(conn, row, return_dict=False):
+# columns of the cards rows passed to print_card, after id
+card_columns = 'nid,ord,due,ivl,factor,reps,lapses'
+card_template = ('Due date: {}\nInterval: {} days\nLast review: {}\n'
+                 'Ease factor: {}%\nReviews: {}\nLapses: {}\n')
+
+def print_card(conn, row, return_dict=False, note=None):
+    """Prints a card from a row of its id and card_columns, and its note from
+    a row of the note's id, mid, flds and tags"""
+    import datetime
     if not row:
         return
 
+    card_id, note_id, order, due, interval, factor, reviews, lapses = row
     creation = get_collection_creation_date(conn)
-    due_date = creation + datetime.timedelta(days=row['due'])
-    interval = row['ivl']
+    due_date = creation + datetime.timedelta(days=due)
     last_review = due_date - datetime.timedelta(days=interval)
-    ease_factor = row['factor']/10
-    reviews = row['reps']
-    lapses = row['lapses']
-    reverse = (row['ord'] == 1)
-    note_id = row['nid']
-    # id is unique
-    note = conn.execute("select mid,flds,tags from notes where id = ?", (note_id,)).fetchone()
+    ease_factor = factor/10
+    reverse = (order == 1)
+    if note is None:
+        # id is unique
+        note = conn.execute("select id,mid,flds,tags from notes where id = ?", (note_id,)).fetchone()
 
     if not return_dict:
         if not quiet:
-            print('# Card {} #'.format(row['id']), file=sys.stderr)
-        print('Due date: {}'.format(due_date))
-        print('Interval: {} days'.format(interval))
-        print('Last review: {}'.format(last_review))
-        print('Ease factor: {}%'.format(ease_factor))
-        print('Reviews: {}'.format(row['reps']))
-        print('Lapses: {}'.format(row['lapses']))
+            renderer.err('# Card {} #\n'.format(card_id))
+        renderer.out(card_template.format(due_date, interval, last_review,
+                                          ease_factor, reviews, lapses))
 
         if note:
-            print_note(conn, note_id, note['mid'], note['flds'], note['tags'], reverse=reverse)
+            print_note(conn, note_id, note[1], note[2], note[3], reverse=reverse)
     else:
         card_dict = {'due_date': str(due_date), 'interval': interval, 'last_review': str(last_review),
                        'ease_factor': ease_factor, 'reviews': reviews, 'lapses': lapses}
-        fields = print_fields(conn, note_id, note['mid'], note['flds'], _json=True, reverse=reverse)
-        note_dict = {note_id : {'fields': fields, 'tags': note['tags']}}
+        fields = print_fields(conn, note_id, note[1], note[2], _json=True, reverse=reverse)
+        note_dict = {note_id : {'fields': fields, 'tags': note[3]}}
         card_dict['note'] = note_dict
         return card_dict
 
@@ -626,65 +2269,685 @@ def print_cards(conn, ids, _json=False):
     if _json:
         cards = collections.OrderedDict()
 
-    for _id in ids:
-        if isinstance(_id, str):
-            try:
-                _id = int(_id.strip())
-            except ValueError:
+    def card_ids():
+        nonlocal success
+        for _id in ids:
+            if isinstance(_id, str):
+                try:
+                    _id = int(_id.strip())
+                except ValueError:
+                    success = False
+                    continue
+            yield _id
+
+    for chunk in read_rows_by_id(conn, 'cards', card_columns, card_ids()):
+        notes = dict()
+        note_ids = set(row[1] for _, row in chunk if row)
+        for note_chunk in read_rows_by_id(conn, 'notes', 'mid,flds,tags', note_ids):
+            for _, note in note_chunk:
+                if note:
+                    notes[note[0]] = note
+        for _id, row in chunk:
+            if row:
+                if not _json:
+                    print_card(conn, row, return_dict=False, note=notes.get(row[1]))
+                else:
+                    dump_record(cards, _id, print_card(conn, row, return_dict=True, note=notes.get(row[1])))
+            elif not quiet:
+                renderer.err('Card with id {} not found, skipping\n'
+                             .format(_id))
                 success = False
-                continue
-        # id is unique
-        row = conn.execute("select id,nid,ord,due,ivl,factor,reps,lapses from cards where id = ?", (_id,)).fetchone()
-        if row:
-            if not _json:
-                print_card(conn, row, return_dict=False)
-            else:
-                cards[_id] =  print_card(conn, row, return_dict=True)
-        elif not quiet:
-            print('Card with id', _id, 'not found, skipping',
-                  file=sys.stderr)
-            success = False
 
     if _json:
-        print(json.dumps(cards))
+        dump_records(cards)
     return success
 
 def dump_cards(conn, ids):
     return print_cards(conn, ids, _json=True)
 
+# columns read by card_stats
+stats_columns = ('due', 'ivl', 'factor', 'reps', 'lapses', 'did', 'queue')
+# percentiles of the intervals reported by card_stats
+stats_percentiles = (10, 25, 50, 75, 90, 99)
+# number of days in card_stats' due forecast
+forecast_days = 30
+
+def read_stats_columns(conn, card_ids=None):
+    """Reads the columns needed by card_stats for all cards, or only those in
+    card_ids, of the models and decks selected with -m and -d. Returns a dict
+    mapping column names to arrays of 64 bit ints, or to the snapshot's
+    columns when there are no filters"""
+    import array
+    import json
+    snapshot = get_snapshot(conn)
+    if snapshot and card_ids is None and not (search_models or search_decks):
+        return dict((name, snapshot.columns['cards.'+name])
+                    for name in stats_columns)
+
+    conditions = []
+    params = []
+    if card_ids is not None:
+        conditions.append('id in (select value from json_each(?))')
+        params.append(json.dumps(card_ids))
+    if search_models:
+        conditions.append('nid in (select id from notes where mid in ({}))'
+                          .format(','.join('?'*len(search_models))))
+        params += search_models
+    if search_decks:
+        conditions.append('did in ({})'.format(','.join('?'*len(search_decks))))
+        params += search_decks
+    query = 'select '+','.join(stats_columns)+' from cards'
+    if conditions:
+        query += ' where '+' and '.join(conditions)
+    # rows are read in chunks, so only the arrays grow with the number of
+    # cards, instead of a tuple per card
+    columns = dict((name, array.array('q')) for name in stats_columns)
+    cursor = conn.execute(query, params)
+    while True:
+        rows = cursor.fetchmany(10000)
+        if not rows:
+            break
+        for name, column in zip(stats_columns, zip(*rows)):
+            columns[name].extend(column)
+    return columns
+
+def compute_stats_numpy(numpy, columns, today):
+    """Computes card_stats' aggregates with numpy"""
+    due, ivl, factor, reps, lapses, did, queue = (
+        numpy.frombuffer(columns[name], dtype=numpy.int64)
+        for name in stats_columns)
+    # due dates are only days for review and relearning cards
+    scheduled = due[(queue == 2) | (queue == 3)]-today
+    upcoming = scheduled[(scheduled >= 0) & (scheduled < forecast_days)]
+    reviewed = ivl > 0
+    intervals = numpy.sort(ivl[reviewed])
+    eases = factor[reviewed]
+    histogram = numpy.bincount(eases//100) if len(eases) else []
+    decks, inverse = numpy.unique(did, return_inverse=True)
+    return {
+        'cards': len(due),
+        'review_cards': len(intervals),
+        'overdue': int((scheduled < 0).sum()),
+        'forecast': numpy.bincount(upcoming,
+                                   minlength=forecast_days).tolist(),
+        'ease': dict((str(i*10), int(n)) for i, n in enumerate(histogram)
+                     if n),
+        'mean_ease': float(eases.mean())/10 if len(eases) else None,
+        'intervals': dict((str(p), int(intervals[len(intervals)*p//100]))
+                          for p in stats_percentiles) if len(intervals)
+                     else {},
+        'mean_interval': float(intervals.mean()) if len(intervals) else None,
+        'decks': deck_stats(decks.tolist(),
+                            numpy.bincount(inverse).tolist(),
+                            numpy.bincount(inverse, weights=reps).tolist(),
+                            numpy.bincount(inverse, weights=lapses).tolist()),
+        }
+
+def compute_stats(columns, today):
+    """Computes card_stats' aggregates in plain python, when numpy is
+    missing"""
+    overdue = 0
+    forecast = [0]*forecast_days
+    histogram = collections.Counter()
+    intervals = []
+    ease_total = 0
+    decks = dict()
+    for due, ivl, factor, reps, lapses, did, queue in zip(
+            *(columns[name] for name in stats_columns)):
+        if queue == 2 or queue == 3:
+            days = due-today
+            if days < 0:
+                overdue += 1
+            elif days < forecast_days:
+                forecast[days] += 1
+        if ivl > 0:
+            intervals.append(ivl)
+            histogram[factor//100] += 1
+            ease_total += factor
+        deck = decks.get(did)
+        if deck is None:
+            decks[did] = [1, reps, lapses]
+        else:
+            deck[0] += 1
+            deck[1] += reps
+            deck[2] += lapses
+    intervals.sort()
+    dids = sorted(decks)
+    return {
+        'cards': len(columns['due']),
+        'review_cards': len(intervals),
+        'overdue': overdue,
+        'forecast': forecast,
+        'ease': dict((str(i*10), histogram[i]) for i in sorted(histogram)),
+        'mean_ease': ease_total/len(intervals)/10 if intervals else None,
+        'intervals': dict((str(p), intervals[len(intervals)*p//100])
+                          for p in stats_percentiles) if intervals else {},
+        'mean_interval': sum(intervals)/len(intervals) if intervals else None,
+        'decks': deck_stats(dids, [decks[did][0] for did in dids],
+                            [decks[did][1] for did in dids],
+                            [decks[did][2] for did in dids]),
+        }
+
+def deck_stats(dids, cards, reviews, lapses):
+    stats = dict()
+    for did, n, r, l in zip(dids, cards, reviews, lapses):
+        stats[str(did)] = {'cards': n, 'reviews': int(r), 'lapses': int(l),
+                           'lapse_rate': l/r if r else 0.0}
+    return stats
+
+def card_stats(conn, ids):
+    """Prints scheduling statistics of all cards, or only the cards in ids, as
+    json: a due forecast per day, an ease histogram, interval percentiles and
+    lapse rates per deck"""
+    import datetime
+    import json
+    card_ids = None
+    if ids:
+        try:
+            card_ids = [int(_id) for _id in ids]
+        except ValueError:
+            renderer.err('Usage: card_stats [card_id]...\n')
+            return False
+
+    with phase('read'):
+        columns = read_stats_columns(conn, card_ids)
+    if not len(columns['due']):
+        if not quiet:
+            renderer.err('No cards found\n')
+        return False
+    today = (datetime.date.today()-get_collection_creation_date(conn)).days
+    try:
+        import numpy
+    except ImportError:
+        numpy = None
+    with phase('compute'):
+        if numpy:
+            stats = compute_stats_numpy(numpy, columns, today)
+        else:
+            stats = compute_stats(columns, today)
+    with phase('write'):
+        renderer.out(json.dumps(stats)+'\n')
+    return True
+
+def parse_watermark(watermark):
+    """Returns the modification time and update sequence number in a
+    watermark printed by changes"""
+    mod, usn = watermark.split(':')
+    return int(mod), int(usn)
+
+# types of the objects whose deletion is recorded in the graves table
+grave_types = {0: 'card', 1: 'note', 2: 'deck'}
+
+def changes(conn, args):
+    """Prints the notes, cards and deletions made after a watermark printed by
+    a previous call (or all notes and cards, without one) as json lines,
+    followed by a line with the new watermark. Changes received from syncing
+    are found through an update sequence number greater than the watermark's,
+    which is indexed, and local changes through usn=-1 and a modification
+    time after the watermark's, which isn't, so every note and card not
+    synced yet is read"""
+    import json
+    if len(args) > 1:
+        renderer.err('Usage: changes [watermark]\n')
+        return False
+    if args:
+        try:
+            since_mod, since_usn = parse_watermark(args[0])
+        except ValueError:
+            renderer.err('Malformed watermark: '+args[0]+'\n')
+            return False
+        where = ' where (usn=-1 and mod>?) or usn>?'
+        params = [since_mod, since_usn]
+    else:
+        where = ''
+        params = []
+
+    # changes made while this runs will be found again by the next call: they
+    # have a modification time after the new watermark's, which is a second
+    # in the past, or an update sequence number greater than its
+    mod = int(time.time())-1
+    usn = max(conn.execute('select max(usn) from notes').fetchone()[0] or 0,
+              conn.execute('select max(usn) from cards').fetchone()[0] or 0)
+
+    n = 0
+    for note_id, model_id, note_mod, note_usn, tagsstr, fieldsstr in \
+            timed_iter('read', conn.execute('select id,mid,mod,usn,tags,flds '
+                                            'from notes'+where, params)):
+        with phase('format'):
+            line = json.dumps({
+                'note': note_id, 'model_id': model_id, 'mod': note_mod,
+                'usn': note_usn, 'tags': tagsstr,
+                'fields': get_fields(conn, model_id, fieldsstr, reverse=False),
+                })
+        with phase('write'):
+            renderer.out(line+'\n')
+        n += 1
+    for row in timed_iter('read', conn.execute(
+            'select id,nid,did,ord,mod,usn,type,queue,due,ivl,factor,reps,'
+            'lapses from cards'+where, params)):
+        with phase('format'):
+            line = json.dumps(dict(zip(('card', 'note_id', 'deck_id', 'ord',
+                                        'mod', 'usn', 'type', 'queue', 'due',
+                                        'ivl', 'factor', 'reps', 'lapses'),
+                                       row)))
+        with phase('write'):
+            renderer.out(line+'\n')
+        n += 1
+    # deletions have no modification time, so local ones are printed until
+    # they're synced
+    try:
+        graves = conn.execute('select oid,type from graves where usn=-1 or '
+                              'usn>?', params[1:]) if args else []
+        for oid, kind in graves:
+            renderer.out(json.dumps({'deleted': oid,
+                                     'type': grave_types.get(kind, kind)})+'\n')
+            n += 1
+    except sqlite3.OperationalError:
+        # collections created by other programs may lack the graves table
+        pass
+
+    renderer.out(json.dumps({'watermark': '{}:{}'.format(mod, usn)})+'\n')
+    if not quiet:
+        renderer.err('{} changes\n'.format(n))
+    return True
+
+
+# long lists of parameters, shortened when printing statements
+parameters_re = LazyPattern('parameters_re', r'\?(?:,\?)+')
+
+class Timings(object):
+    """Time spent in each phase of a command and in each sql statement.
+    Phases include the time spent in the statements executed during them"""
+
+    def __init__(self):
+        # name -> [calls, seconds]
+        self.phases = collections.defaultdict(lambda: [0, 0.0])
+        # sql -> [executions, seconds], including fetching the rows
+        self.statements = collections.defaultdict(lambda: [0, 0.0])
+        self.start = time.perf_counter()
+
+    def add(self, name, seconds, calls=1):
+        phase = self.phases[name]
+        phase[0] += calls
+        phase[1] += seconds
+
+    def add_statement(self, sql, seconds, executions=0):
+        statement = self.statements[sql]
+        statement[0] += executions
+        statement[1] += seconds
+
+    def as_dict(self):
+        return {
+            'total': time.perf_counter()-self.start,
+            'queries': sum(calls for calls, _ in self.statements.values()),
+            'phases': dict((name, {'calls': calls, 'seconds': seconds})
+                           for name, (calls, seconds) in self.phases.items()),
+            'statements': [{'sql': sql, 'executions': calls, 'seconds': seconds}
+                           for sql, (calls, seconds)
+                           in sorted(self.statements.items(),
+                                     key=lambda item: -item[1][1])],
+            }
+
+    def report(self, file=None):
+        file = file or sys.stderr
+        timings = self.as_dict()
+        print('Total: {:.3f}s, {} queries'.format(timings['total'],
+                                                  timings['queries']),
+              file=file)
+        print('Phases:', file=file)
+        for name, phase in sorted(timings['phases'].items(),
+                                  key=lambda item: -item[1]['seconds']):
+            print('  {:<10} {:9.3f}s {:>10} calls'.format(
+                      name, phase['seconds'], phase['calls']), file=file)
+        print('Statements:', file=file)
+        for statement in timings['statements']:
+            sql = parameters_re.sub('?,...', ' '.join(statement['sql'].split()))
+            print('  {:9.3f}s {:>10} x {}'.format(
+                      statement['seconds'], statement['executions'], sql),
+                  file=file)
+
+class TimedPhase(object):
+    __slots__ = ('name', 'start')
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+
+    def __exit__(self, *exc):
+        timings.add(self.name, time.perf_counter()-self.start)
+
+class UntimedPhase(object):
+    __slots__ = ()
+    def __enter__(self):
+        pass
+    def __exit__(self, *exc):
+        pass
+untimed_phase = UntimedPhase()
+
+def phase(name):
+    """Returns a context manager adding the time spent in it to the phase
+    name, if timings are being recorded"""
+    if timings is None:
+        return untimed_phase
+    return TimedPhase(name)
+
+def timed_iter(name, iterable):
+    """Yields from iterable, adding the time spent getting each item to the
+    phase name, if timings are being recorded"""
+    if timings is None:
+        yield from iterable
+        return
+    iterator = iter(iterable)
+    while True:
+        start = time.perf_counter()
+        try:
+            item = next(iterator)
+        except StopIteration:
+            timings.add(name, time.perf_counter()-start, calls=0)
+            return
+        timings.add(name, time.perf_counter()-start)
+        yield item
+
+class TimedCursor(object):
+    """Wraps a cursor, adding the time spent executing its statement and
+    fetching its rows to timings"""
+
+    def __init__(self, cursor, sql):
+        self.cursor = cursor
+        self.sql = sql
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        start = time.perf_counter()
+        try:
+            return next(self.cursor)
+        finally:
+            timings.add_statement(self.sql, time.perf_counter()-start)
+
+    def fetchone(self):
+        start = time.perf_counter()
+        row = self.cursor.fetchone()
+        timings.add_statement(self.sql, time.perf_counter()-start)
+        return row
+
+    def fetchmany(self, *args):
+        start = time.perf_counter()
+        rows = self.cursor.fetchmany(*args)
+        timings.add_statement(self.sql, time.perf_counter()-start)
+        return rows
+
+    def fetchall(self):
+        start = time.perf_counter()
+        rows = self.cursor.fetchall()
+        timings.add_statement(self.sql, time.perf_counter()-start)
+        return rows
+
+    def __getattr__(self, name):
+        return getattr(self.cursor, name)
+
+class TimedConnection(sqlite3.Connection):
+    """Connection recording every statement it executes in timings, if
+    they're enabled"""
+
+    def execute(self, sql, *args):
+        if not timings:
+            return super().execute(sql, *args)
+        start = time.perf_counter()
+        cursor = super().execute(sql, *args)
+        timings.add_statement(sql, time.perf_counter()-start, executions=1)
+        return TimedCursor(cursor, sql)
+
+    def executemany(self, sql, *args):
+        if not timings:
+            return super().executemany(sql, *args)
+        start = time.perf_counter()
+        cursor = super().executemany(sql, *args)
+        timings.add_statement(sql, time.perf_counter()-start, executions=1)
+        return cursor
+
+# the collection's modification time when the caches were last checked
+def refresh_caches(conn):
+    """Empties the caches of data read from the collection's col table (models,
+    layouts and creation date) if it was modified since they were filled, and
+    drops the snapshot so it's checked again"""
+    caches = get_caches(conn)
+    # the snapshot checks for modifications itself, including notes modified
+    # without changing col.mod
+    caches.snapshot = None
+    mod = conn.execute('select mod from col where id=1').fetchone()[0]
+    if mod != caches.mod:
+        caches.models = None
+        caches.layouts.clear()
+        caches.creation_date = None
+        caches.mod = mod
+
+def is_collection_path(conn, path):
+    """Tells whether path is the file of conn's collection"""
+    collection_path = get_collection_path(conn)
+    try:
+        return bool(collection_path) and os.path.samefile(path, collection_path)
+    except OSError:
+        return False
+
+def handle_request(conn, parser, request):
+    """Runs a command line sent to the server. request is a dict with the
+    command line arguments in 'argv' and, optionally, the command's input in
+    'stdin'. Returns a dict with the command's output in 'stdout' and
+    'stderr', and its exit status in 'status'"""
+    import io
+    import contextlib
+    stdout = io.StringIO()
+    stderr = io.StringIO()
+    real_stdin = sys.stdin
+    sys.stdin = io.StringIO(request.get('stdin') or '')
+    try:
+        with contextlib.redirect_stdout(stdout), \
+             contextlib.redirect_stderr(stderr):
+            try:
+                argv = request.get('argv') or []
+                opts = parse_simple_args(argv) or parser.parse_args(argv)
+                if opts.command == 'serve':
+                    print('Error: the server is already running.',
+                          file=sys.stderr)
+                    status = 1
+                elif opts.db and not is_collection_path(conn, opts.db):
+                    print('Error: the server is serving ‘',
+                          get_collection_path(conn), '’, not ‘', opts.db,
+                          '’.', sep='', file=sys.stderr)
+                    status = 1
+                else:
+                    apply_options(opts)
+                    refresh_caches(conn)
+                    # there's no one to confirm changes, so only -f commits
+                    if execute(conn, opts, confirm=lambda: False):
+                        status = 0
+                    else:
+                        status = 2
+            except SystemExit as e:
+                # argparse errors and --help
+                status = e.code if isinstance(e.code, int) else 1
+            except Exception as e:
+                print('Error:', e, file=sys.stderr)
+                if conn.in_transaction:
+                    conn.rollback()
+                status = 1
+    finally:
+        sys.stdin = real_stdin
+    return {'stdout': stdout.getvalue(), 'stderr': stderr.getvalue(),
+            'status': status}
+
+def handle_request_line(conn, parser, line):
+    import json
+    try:
+        request = json.loads(line)
+        if type(request) != dict:
+            raise ValueError
+    except ValueError:
+        return {'stdout': '', 'stderr': 'Malformed request: '+line, 'status': 1}
+    return handle_request(conn, parser, request)
+
+def serve(conn, args):
+    """Keeps the collection open and its models parsed, and runs command lines
+    sent as json lines through a unix socket, if its path is given, or
+    through stdin"""
+    import json
+    parser = create_parser()
+    if not args:
+        if not quiet:
+            print('Reading requests from stdin...', file=sys.stderr)
+        for line in sys.stdin:
+            response = handle_request_line(conn, parser, line)
+            print(json.dumps(response), flush=True)
+        return True
+
+    import socketserver
+    import stat
+    import signal
+    class Handler(socketserver.StreamRequestHandler):
+        def handle(self):
+            for line in self.rfile:
+                response = handle_request_line(conn, parser,
+                                               line.decode('utf-8'))
+                self.wfile.write(json.dumps(response).encode('utf-8')+b'\n')
+                self.wfile.flush()
+
+    path = args[0]
+    # removing sockets left by servers that didn't exit cleanly
+    if os.path.exists(path) and stat.S_ISSOCK(os.stat(path).st_mode):
+        os.remove(path)
+    server = socketserver.UnixStreamServer(path, Handler)
+    # exiting through the finally clause below on kill
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    if not quiet:
+        print('Listening on ‘', path, '’...', sep='', file=sys.stderr)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        os.remove(path)
+    return True
+
+# command line command -> handler function
+commands = {
+    'dump_fields': dump_notes_fields,
+    'dump_tags': dump_notes_tags,
+    'dump_notes': dump_notes,
+    'list_decks': list_decks,
+    'list_models': list_models,
+    'mv_tags': rename_tags,
+    'print_notes': print_notes,
+    'print_fields': print_notes_fields,
+    'print_tags': print_notes_tags,
+    'replace_fields': replace_fields,
+    'replace_tags': replace_tags,
+    'rm_tags': remove_tags,
+    'search': search_notes,
+    'search_field': search_notes_field,
+    'search_fields_only': search_notes_fields,
+    'search_tags': search_notes_tags,
+    'search_cards': search_cards,
+    'print_cards': print_cards,
+    'dump_cards': dump_cards,
+    'card_stats': card_stats,
+    'changes': changes,
+    'find_duplicates': find_duplicates,
+    'add_notes': add_notes,
+    'update_index': update_search_index,
+    'serve': serve,
+    }
+
+# commands that never modify the collection, which open it read-only
+# (update_index only writes to the search index)
+read_only_commands = set([
+    'search', 'search_field', 'search_fields_only', 'search_tags',
+    'search_cards', 'list_decks', 'list_models', 'print_fields',
+    'dump_fields', 'print_tags', 'dump_tags', 'print_notes', 'dump_notes',
+    'print_cards', 'dump_cards', 'card_stats', 'changes', 'find_duplicates',
+    'update_index',
+    ])
 
 quiet = False
 human_readable = False
-def run():
-    global quiet
-    global human_readable
-
-    # command line command -> handler function
-    commands = {
-        'dump_fields': dump_notes_fields,
-        'dump_tags': dump_notes_tags,
-        'dump_notes': dump_notes,
-        'list_decks': list_decks,
-        'list_models': list_models,
-        'mv_tags': rename_tags,
-        'print_notes': print_notes,
-        'print_fields': print_notes_fields,
-        'print_tags': print_notes_tags,
-        'replace_fields': replace_fields,
-        'replace_tags': replace_tags,
-        'rm_tags': remove_tags,
-        'search': search_notes,
-        'search_field': search_notes_field,
-        'search_fields_only': search_notes_fields,
-        'search_tags': search_notes_tags,
-        'search_cards': search_cards,
-        'print_cards': print_cards,
-        'dump_cards': dump_cards,
-        }
+case_sensitive = False
+search_models = []
+search_decks = []
+use_index = False
+use_snapshot = False
+csum_filter = False
+output_format = 'json'
+input_format = 'json'
+jobs = 1
+timings = None
+
+# values of the command line options when they aren't given, taken before
+# any command line changes the module's options
+default_options = dict(force=False, quiet=False, human_readable=False,
+                       case_sensitive=False, models=[], decks=[], index=False,
+                       snapshot=False, csum_filter=False,
+                       batch_size=batch_size,
+                       format=output_format, input_format=input_format,
+                       jobs=jobs, timings=False,
+                       timings_json=None, profile=None, db=None, connect=None)
+
+# switches parse_simple_args understands, and the options they set
+simple_switches = {
+    '-f': 'force', '--force': 'force',
+    '-q': 'quiet', '--quiet': 'quiet',
+    '-r': 'human_readable', '--human-readable': 'human_readable',
+    '-s': 'case_sensitive', '--case-sensitive': 'case_sensitive',
+    '-i': 'index', '--index': 'index',
+    '--snapshot': 'snapshot',
+    '--csum-filter': 'csum_filter',
+    '-t': 'timings', '--timings': 'timings',
+    }
+
+def parse_simple_args(argv):
+    """Parses the usual short command lines, made of switches without values,
+    -c and a command with its arguments, without importing argparse and
+    building its parser, which take longer than most commands on small
+    collections. Returns the options, or None for anything else, including
+    --help and errors, which are left to create_parser's parser"""
+    opts = dict(default_options, models=[], decks=[])
+    i = 0
+    while i < len(argv):
+        arg = argv[i]
+        if arg in simple_switches:
+            opts[simple_switches[arg]] = True
+        elif arg in ('-c', '--collection') and i+1 < len(argv):
+            i += 1
+            opts['db'] = argv[i]
+        elif arg.startswith('-'):
+            # combined switches such as -qf
+            if (len(arg) < 3 or arg.startswith('--') or
+                    not all('-'+c in simple_switches for c in arg[1:])):
+                return None
+            for c in arg[1:]:
+                opts[simple_switches['-'+c]] = True
+        else:
+            break
+        i += 1
+    if i == len(argv) or argv[i] not in commands:
+        return None
+    arguments = argv[i+1:]
+    # argparse would read these as options
+    if any(arg.startswith('-') for arg in arguments):
+        return None
+    opts['command'] = argv[i]
+    opts['arguments'] = arguments
+    import types
+    return types.SimpleNamespace(**opts)
 
-    # parsing command line
+def create_parser():
+    import argparse
     parser = argparse.ArgumentParser(description='Low level manipulation of '
                                                  'anki collections')
+    parser.set_defaults(**default_options)
     parser.add_argument('-f', '--force', dest='force', action='store_true',
                         help='force committing changes to database')
     parser.add_argument('-q', '--quiet', dest='quiet', action='store_true',
@@ -694,6 +2957,60 @@ def run():
                         action='store_true', help="search functions will print "
                         "human readable output (equivalent to piping to the "
                         "appropriate print_* funcition)")
+    parser.add_argument('-s', '--case-sensitive', dest='case_sensitive',
+                        action='store_true', help='search patterns are '
+                        'case-sensitive')
+    parser.add_argument('-m', '--model', dest='models', action='append',
+                        metavar='model',
+                        help='search only notes of this model, given by id or '
+                             'name (may be used more than once)')
+    parser.add_argument('-d', '--deck', dest='decks', action='append',
+                        metavar='deck',
+                        help='search only notes with cards in this deck or '
+                             'its subdecks, given by id or name (may be used '
+                             'more than once)')
+    parser.add_argument('-i', '--index', dest='index', action='store_true',
+                        help='use (and update) the search index kept next '
+                             'to the collection for word searches')
+    parser.add_argument('--snapshot', dest='snapshot', action='store_true',
+                        help='read notes and cards from a compact snapshot '
+                             'kept next to the collection, mapped in memory '
+                             '(read-only commands only)')
+    parser.add_argument('--csum-filter', dest='csum_filter',
+                        action='store_true',
+                        help="find_duplicates only compares notes whose "
+                             "first field has the same checksum as another "
+                             "note's, as anki computes it (faster, but "
+                             "misses notes differing only in case or "
+                             "whitespace)")
+    parser.add_argument('-b', '--batch-size', dest='batch_size', type=int,
+                        metavar='n',
+                        help='number of notes modified at once by the '
+                             'replace_* commands (default: %(default)s)')
+    parser.add_argument('-F', '--format', dest='format',
+                        choices=['json', 'ndjson'],
+                        help='format of the dump_* commands: a single json '
+                             'object, or one object per note or card, printed '
+                             'as soon as it is read (default: %(default)s)')
+    parser.add_argument('--input-format', dest='input_format',
+                        choices=['json', 'csv'],
+                        help='format of the notes read by add_notes: a json '
+                             'object per line, or csv rows of model, deck, '
+                             'tags and fields (default: %(default)s)')
+    parser.add_argument('-j', '--jobs', dest='jobs', type=int, metavar='n',
+                        help='number of processes searching notes at the '
+                             'same time (default: %(default)s)')
+    parser.add_argument('-t', '--timings', dest='timings',
+                        action='store_true',
+                        help='print how long each phase of the command and '
+                             'each sql statement took to stderr')
+    parser.add_argument('--timings-json', dest='timings_json',
+                        metavar='json_file',
+                        help='save the timings printed by -t to json_file '
+                             'instead')
+    parser.add_argument('--profile', dest='profile', metavar='profile_file',
+                        help='profile the command with cProfile and save the '
+                             'results to profile_file')
     parser.add_argument('-c', '--collection', dest='db',
                         metavar='collection_db',
                         help='collection database file')
@@ -701,13 +3018,141 @@ def run():
                         help='command to execute')
     parser.add_argument('arguments', nargs='*',
                         help='arguments for the command')
-    opts = parser.parse_args()
+    parser.add_argument('--connect', dest='connect', metavar='socket',
+                        help='run the command in a server started with serve, '
+                             'listening on socket')
+    return parser
+
+def apply_options(opts):
+    """Sets the module's options from parsed command line options"""
+    global batch_size
+    global quiet
+    global human_readable
+    global case_sensitive
+    global search_models
+    global search_decks
+    global use_index
+    global use_snapshot
+    global csum_filter
+    global output_format
+    global input_format
+    global jobs
+    global timings
+
+    quiet = opts.quiet
+    human_readable = opts.human_readable
+    case_sensitive = opts.case_sensitive
+    use_index = opts.index
+    use_snapshot = opts.snapshot and opts.command in read_only_commands
+    csum_filter = opts.csum_filter
+    if opts.batch_size > 0:
+        batch_size = opts.batch_size
+    output_format = opts.format
+    input_format = opts.input_format
+    jobs = max(1, opts.jobs)
+    # resolved to ids by execute, once the collection is open
+    search_models = opts.models
+    search_decks = opts.decks
+    if opts.timings or opts.timings_json:
+        timings = Timings()
+    else:
+        timings = None
+
+def execute(connection, opts, confirm=prompt_confirmation):
+    """Runs the command in opts and commits its changes if it succeeded and
+    they are confirmed, rolling them back otherwise. Returns whether the
+    command succeeded"""
+    import json
+    global search_models
+    global search_decks
+    global renderer
+    global committed_output
+    try:
+        search_models = resolve_names(connection, 'models', opts.models)
+        search_decks = resolve_names(connection, 'decks', opts.decks)
+    except ValueError as e:
+        print('Error:', e, file=sys.stderr)
+        return False
+
+    if opts.profile:
+        import cProfile
+        profiler = cProfile.Profile()
+        profiler.enable()
+    renderer = Renderer(renderer_limit)
+    committed_output = []
+    try:
+        success = commands[opts.command](connection, opts.arguments)
+    except KeyboardInterrupt:
+        success = False
+    finally:
+        renderer.flush()
+        renderer = Renderer()
+    if opts.profile:
+        profiler.disable()
+        profiler.dump_stats(opts.profile)
+
+    if timings:
+        sys.stdout.flush()
+        if opts.timings_json:
+            with open(opts.timings_json, 'w') as f:
+                json.dump(timings.as_dict(), f, indent=1)
+        else:
+            timings.report()
+
+    # committing transactions
+    if success and connection.in_transaction:
+        if opts.force or confirm():
+            connection.commit()
+            sys.stdout.write(''.join(committed_output))
+        else:
+            print('\nCanceling changes. Your collection was not modified.',
+                  '(If piping to stdin or using -q, use the -f switch to force '
+                  'committing.)',
+                  sep='\n', file=sys.stderr)
+            success = False
+    committed_output = None
+    if connection.in_transaction:
+        connection.rollback()
+    return success
+
+def run_client(path, argv, arguments):
+    """Sends a command line to a server started with serve and prints its
+    output. arguments are the command's arguments in argv. Returns the
+    command's exit status"""
+    import json
+    import socket
+    # commands only read stdin when they have no arguments
+    if not arguments and not sys.stdin.isatty():
+        stdin = sys.stdin.read()
+    else:
+        stdin = None
+    try:
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.connect(path)
+    except OSError as e:
+        print("Error: couldn't connect to server at ‘", path, '’: ', e,
+              sep='', file=sys.stderr)
+        return 1
+    with sock, sock.makefile('rwb') as f:
+        f.write(json.dumps({'argv': argv, 'stdin': stdin}).encode('utf-8')+
+                b'\n')
+        f.flush()
+        response = json.loads(f.readline().decode('utf-8'))
+    sys.stdout.write(response['stdout'])
+    sys.stderr.write(response['stderr'])
+    return response['status']
 
-    if opts.quiet:
-        quiet = True
+def run():
+    opts = parse_simple_args(sys.argv[1:])
+    if opts is None:
+        opts = create_parser().parse_args()
 
-    if opts.human_readable:
-        human_readable = True
+    # the server parses the command line again, ignoring --connect and
+    # refusing a -c other than the collection it serves
+    if opts.connect:
+        exit(run_client(opts.connect, sys.argv[1:], opts.arguments))
+
+    apply_options(opts)
 
     if opts.db:
         collection = opts.db
@@ -722,26 +3167,18 @@ def run():
                   "location with -c.", file=sys.stderr)
             exit(1)
 
-    # connecting to the database
-    connection = sqlite3.connect(collection)
-    connection.row_factory = sqlite3.Row
+    # connecting to the database (the server's requests can enable timings)
+    if timings or opts.command == 'serve':
+        factory = TimedConnection
+    else:
+        factory = sqlite3.Connection
+    if opts.command in read_only_commands:
+        connection = connect_read_only(collection, factory=factory)
+    else:
+        connection = sqlite3.connect(collection, factory=factory)
 
     # executing
-    try:
-        success = commands[opts.command](connection, opts.arguments)
-    except KeyboardInterrupt:
-        success = False
-
-    # committing transactions
-    if success and connection.in_transaction:
-        if opts.force or prompt_confirmation():
-            connection.commit()
-        else:
-            print('\nCanceling changes. Your collection was not modified.',
-                  '(If piping to stdin or using -q, use the -f switch to force '
-                  'committing.)',
-                  sep='\n', file=sys.stderr)
-            success = False
+    success = execute(connection, opts)
 
     # cleaning up
     connection.close()
@@ -750,8 +3187,10 @@ def run():
     else:
         exit(2)
 
-# Only run if being executed directly, so other scripts can source this one and
-# call its functions. Note that, in this case, the caller is responsible for
-# opening and closing the database and committing any changes.
-if os.path.splitext(os.path.basename(sys.argv[0]))[0] == 'anki_tool':
+# Only run if being executed directly (and not imported by the processes
+# searching with --jobs), so other scripts can source this one and call its
+# functions. Note that, in this case, the caller is responsible for opening
+# and closing the database and committing any changes.
+if (__name__ == '__main__' and
+    os.path.splitext(os.path.basename(sys.argv[0]))[0] == 'anki_tool'):
     run()
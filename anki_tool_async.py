@@ -0,0 +1,244 @@
+"""Asyncio interface to anki_tool, returning structured results instead of
+printing them. All sqlite work runs on a thread dedicated to each collection,
+so services can query collections without blocking their event loop. For
+example:
+
+    import anki_tool_async
+
+    async def main():
+        collection = await anki_tool_async.Collection.open('collection.anki2')
+        async for note in collection.dump_notes(collection.search(['bird'])):
+            print(note['id'], note['fields'])
+        await collection.close()
+
+Searches use anki_tool's options (-i, -j, -m, -d), which are module globals
+shared by every collection. The models and other data anki_tool caches are
+kept per connection, so each collection only sees its own"""
+
+import asyncio
+import concurrent.futures
+import functools
+import itertools
+import sqlite3
+import threading
+import anki_tool
+
+class Collection(object):
+    """An anki collection whose connection lives on a thread of its own.
+    Create it with Collection.open"""
+
+    def __init__(self, path):
+        self.path = path
+        # a single thread, since a connection can only be used from the thread
+        # that created it
+        self.executor = concurrent.futures.ThreadPoolExecutor(
+                            max_workers=1, thread_name_prefix='anki_tool')
+        self.conn = None
+        # held while anki_tool works on the collection
+        self.lock = threading.Lock()
+
+    @classmethod
+    async def open(cls, path):
+        collection = cls(path)
+        await collection.call(collection._connect)
+        return collection
+
+    def _connect(self):
+        self.conn = sqlite3.connect(self.path)
+
+    def _disconnect(self):
+        with self.lock:
+            self.conn.close()
+            anki_tool.drop_caches(self.conn)
+            self.conn = None
+
+    async def close(self):
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(self.executor, self._disconnect)
+        self.executor.shutdown()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+    async def call(self, function, *args, **kwargs):
+        """Runs function on the collection's thread and returns its result.
+        Functions from anki_tool must be given the connection, self.conn, as
+        their first argument"""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+                   self.executor, self._run,
+                   functools.partial(function, *args, **kwargs))
+
+    def _run(self, function):
+        """Calls function, first emptying the collection's caches if it was
+        modified since they were filled, e.g. by anki editing a model"""
+        with self.lock:
+            if self.conn:
+                anki_tool.refresh_caches(self.conn)
+            return function()
+
+    async def iterate(self, function, *args, size=anki_tool.chunk_size,
+                      **kwargs):
+        """Yields the items of the iterable returned by function, which is
+        called and consumed on the collection's thread in batches of size"""
+        iterator = await self.call(lambda: iter(function(*args, **kwargs)))
+        try:
+            while True:
+                batch = await self.call(list, itertools.islice(iterator, size))
+                if not batch:
+                    break
+                for item in batch:
+                    yield item
+        finally:
+            # releasing the statements of searches stopped early
+            if hasattr(iterator, 'close'):
+                await self.call(iterator.close)
+
+    async def search(self, regexps, only_field=None, only_tags=False,
+                     model_ids=None, deck_ids=None, case_sensitive=False):
+        """Yields the ids of the notes matching all regexps"""
+        async for row, _, _ in self.iterate(
+                anki_tool.find_notes, self.conn, regexps, only_field=only_field,
+                only_tags=only_tags, need_cards=False, model_ids=model_ids,
+                deck_ids=deck_ids, sensitive=case_sensitive):
+            yield row[0]
+
+    async def search_cards(self, regexps, model_ids=None, deck_ids=None,
+                           case_sensitive=False):
+        """Yields the ids of the cards of the notes matching all regexps"""
+        async for _, card_ids, _ in self.iterate(
+                anki_tool.find_notes, self.conn, regexps, model_ids=model_ids,
+                deck_ids=deck_ids, sensitive=case_sensitive):
+            for card_id in card_ids:
+                yield card_id
+
+    async def dump_notes(self, ids):
+        """Yields a dict with the id, model id, fields (an OrderedDict of field
+        names and values), tags and card ids of each note found. ids may be an
+        iterable or an async iterable, such as the one returned by search"""
+        async for chunk in self._chunks(ids):
+            for note in await self.call(self._read_notes, chunk):
+                yield note
+
+    def _read_notes(self, ids):
+        notes = []
+        no_cards = ([], None)
+        for chunk in anki_tool.read_rows_by_id(self.conn, 'notes',
+                                               'mid,flds,tags', ids):
+            rows = [row for _, row in chunk if row]
+            cards_map = anki_tool.get_cards_map(self.conn,
+                                                [row[0] for row in rows])
+            for note_id, model_id, fieldsstr, tagsstr in rows:
+                notes.append({
+                    'id': note_id,
+                    'model_id': model_id,
+                    'fields': anki_tool.create_fields_dict(self.conn, model_id,
+                                                           fieldsstr,
+                                                           reverse=False),
+                    'tags': tagsstr.split(),
+                    'cards': cards_map.get(note_id, no_cards)[0],
+                    })
+        return notes
+
+    async def dump_cards(self, ids):
+        """Yields a dict for each card found, as dump_cards prints them, with
+        its id added. ids may be an iterable or an async iterable, such as the
+        one returned by search_cards"""
+        async for chunk in self._chunks(ids):
+            for card in await self.call(self._read_cards, chunk):
+                yield card
+
+    def _read_cards(self, ids):
+        cards = []
+        for chunk in anki_tool.read_rows_by_id(
+                self.conn, 'cards', anki_tool.card_columns, ids):
+            rows = [row for _, row in chunk if row]
+            notes = dict()
+            for note_chunk in anki_tool.read_rows_by_id(
+                    self.conn, 'notes', 'mid,flds,tags',
+                    set(row[1] for row in rows)):
+                for _, note in note_chunk:
+                    if note:
+                        notes[note[0]] = note
+            for row in rows:
+                note = notes.get(row[1])
+                if not note:
+                    continue
+                card = anki_tool.print_card(self.conn, row, return_dict=True,
+                                            note=note)
+                card['id'] = row[0]
+                cards.append(card)
+        return cards
+
+    async def _chunks(self, ids):
+        """Yields lists of at most chunk_size ids from an iterable or an async
+        iterable"""
+        chunk = []
+        if hasattr(ids, '__aiter__'):
+            async for _id in ids:
+                chunk.append(_id)
+                if len(chunk) >= anki_tool.chunk_size:
+                    yield chunk
+                    chunk = []
+        else:
+            for _id in ids:
+                chunk.append(_id)
+                if len(chunk) >= anki_tool.chunk_size:
+                    yield chunk
+                    chunk = []
+        if chunk:
+            yield chunk
+
+    async def models(self):
+        """Returns a dict mapping model ids to names"""
+        return await self.call(self._read_names, 'models')
+
+    async def decks(self):
+        """Returns a dict mapping deck ids to names"""
+        return await self.call(self._read_names, 'decks')
+
+    def _read_names(self, keyword):
+        return dict(anki_tool.get_name_index(self.conn, keyword).names)
+
+    async def resolve(self, keyword, names):
+        """Returns the ids of the models or decks (depending on keyword) with
+        the given names or ids, as the -m and -d switches select them"""
+        return await self.call(anki_tool.resolve_names, self.conn, keyword,
+                               [str(name) for name in names])
+
+    async def replace_fields(self, notes, commit=True):
+        """Sets the fields of notes from a dict mapping note ids to lists of
+        field values, in the order of their model's fields. Returns the number
+        of notes modified"""
+        return await self.call(self._replace, notes, 'flds',
+                               '\x1f'.join, commit)
+
+    async def replace_tags(self, notes, commit=True):
+        """Sets the tags of notes from a dict mapping note ids to lists of
+        tags. Returns the number of notes modified"""
+        return await self.call(self._replace, notes, 'tags',
+                               self._tags_value, commit)
+
+    @staticmethod
+    def _tags_value(tags):
+        if not tags:
+            return ''
+        return ' {} '.format(' '.join(tags))
+
+    def _replace(self, notes, column, to_value, commit):
+        writer = anki_tool.NotesWriter(self.conn, [column])
+        for _id, value in notes.items():
+            writer.add(_id, to_value(value))
+        writer.flush()
+        if commit:
+            self.conn.commit()
+        return writer.written
+
+    async def commit(self):
+        await self.call(self.conn.commit)
+
+    async def rollback(self):
+        await self.call(self.conn.rollback)
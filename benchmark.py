@@ -0,0 +1,407 @@
+#! /usr/bin/python3
+"""Time every anki_tool command against synthetic collections of different
+sizes, and how long anki_tool takes to start, and print the results as json,
+so they can be compared between versions.
+Usage: ./benchmark.py [-n notes]... [-r runs] [-o results.json] [--compare old_results.json]"""
+
+import sys
+import os
+import os.path
+import shutil
+import sqlite3
+import json
+import random
+import hashlib
+import time
+import argparse
+import platform
+import subprocess
+import statistics
+
+import anki_tool
+
+anki_tool_path = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                              'anki_tool.py')
+launcher_path = os.path.join(os.path.dirname(anki_tool_path), 'anki_tool')
+
+schema = """
+create table col (id integer primary key, crt integer not null,
+    mod integer not null, scm integer not null, ver integer not null,
+    dty integer not null, usn integer not null, ls integer not null,
+    conf text not null, models text not null, decks text not null,
+    dconf text not null, tags text not null);
+create table notes (id integer primary key, guid text not null,
+    mid integer not null, mod integer not null, usn integer not null,
+    tags text not null, flds text not null, sfld integer not null,
+    csum integer not null, flags integer not null, data text not null);
+create table cards (id integer primary key, nid integer not null,
+    did integer not null, ord integer not null, mod integer not null,
+    usn integer not null, type integer not null, queue integer not null,
+    due integer not null, ivl integer not null, factor integer not null,
+    reps integer not null, lapses integer not null, left integer not null,
+    odue integer not null, odid integer not null, flags integer not null,
+    data text not null);
+create table revlog (id integer primary key, cid integer not null,
+    usn integer not null, ease integer not null, ivl integer not null,
+    lastIvl integer not null, factor integer not null, time integer not null,
+    type integer not null);
+create table graves (usn integer not null, oid integer not null,
+    type integer not null);
+create index ix_notes_usn on notes (usn);
+create index ix_cards_usn on cards (usn);
+create index ix_revlog_usn on revlog (usn);
+create index ix_cards_nid on cards (nid);
+create index ix_cards_sched on cards (did, queue, due);
+create index ix_revlog_cid on revlog (cid);
+create index ix_notes_csum on notes (csum);
+"""
+
+words = ('red blue green car house bird whale fish color sport date word '
+         'Britain café garçon niño straße über Ärger river mountain').split()
+tags = ('color bird sport animal::mammal animal::fish leccion1 leccion2 '
+        'leccion3 spanish::verbs spanish::nouns geography history').split()
+
+def create_model(model_id, name, field_names, templates):
+    return {
+        'id': model_id,
+        'name': name,
+        'type': 0,
+        'sortf': 0,
+        'did': 1,
+        'mod': 0,
+        'usn': -1,
+        'tags': [],
+        'vers': [],
+        'css': '',
+        'latexPre': '',
+        'latexPost': '',
+        'req': [],
+        'flds': [{'name': field_name, 'ord': i, 'sticky': False, 'rtl': False,
+                  'font': 'Arial', 'size': 20, 'media': []}
+                 for i, field_name in enumerate(field_names)],
+        'tmpls': [{'name': 'Card {}'.format(i+1), 'ord': i, 'qfmt': qfmt,
+                   'afmt': afmt, 'did': None, 'bqfmt': '', 'bafmt': ''}
+                  for i, (qfmt, afmt) in enumerate(templates)],
+        }
+
+def generate_collection(path, n, seed=0):
+    """Creates a collection with n notes, with the same schema and json blobs
+    as anki 2 collections, and random fields, tags and scheduling"""
+    rng = random.Random(seed)
+    if os.path.exists(path):
+        os.remove(path)
+    conn = sqlite3.connect(path)
+    conn.executescript(schema)
+
+    crt = 1360000000
+    models = {
+        '1342697561419': create_model(1342697561419, 'Basic',
+                                      ['Front', 'Back'],
+                                      [('{{Front}}', '{{Back}}')]),
+        '1342697561420': create_model(1342697561420,
+                                      'Basic (optional reversed card)',
+                                      ['Front', 'Back', 'Reverse'],
+                                      [('{{Front}}', '{{Back}}'),
+                                       ('{{#Reverse}}{{Back}}{{/Reverse}}',
+                                        '{{Front}}')]),
+        }
+    decks = {
+        '1': {'id': 1, 'name': 'Default'},
+        '1360000000001': {'id': 1360000000001, 'name': 'Languages::Spanish'},
+        '1360000000002': {'id': 1360000000002, 'name': 'Geography'},
+        }
+    conn.execute('insert into col values (1,?,?,?,11,0,0,0,?,?,?,?,?)',
+                 (crt, crt*1000, crt*1000, json.dumps({'nextPos': n+1}),
+                  json.dumps(models), json.dumps(decks), '{}',
+                  json.dumps(dict((tag, 0) for tag in tags))))
+
+    model_ids = [int(model_id) for model_id in models]
+    deck_ids = [int(deck_id) for deck_id in decks]
+    note_id = crt*1000
+    card_id = crt*1000
+    today = (int(time.time())-crt)//86400
+    for first in range(0, n, 10000):
+        notes = []
+        cards = []
+        for i in range(first, min(first+10000, n)):
+            note_id += 1
+            model_id = rng.choice(model_ids)
+            fields = ['<b>{}</b> {}'.format(rng.choice(words), rng.choice(words)),
+                      '{}<br>{}<div>{}</div>'.format(rng.choice(words),
+                                                     rng.choice(words),
+                                                     rng.choice(words))]
+            if model_id == model_ids[1]:
+                fields.append(rng.choice(['y', '']))
+            note_tags = rng.sample(tags, rng.randint(0, 3))
+            tagsstr = ' {} '.format(' '.join(note_tags)) if note_tags else ''
+            sfld = anki_tool.html_tag_re.sub('', fields[0])
+            csum = int(hashlib.sha1(sfld.encode('utf-8')).hexdigest()[:8], 16)
+            notes.append((note_id, '{:x}'.format(rng.getrandbits(60)),
+                          model_id, crt+i, -1, tagsstr, '\x1f'.join(fields),
+                          sfld, csum, 0, ''))
+            deck_id = rng.choice(deck_ids)
+            for ord in range(len(models[str(model_id)]['tmpls'])):
+                card_id += 1
+                if rng.random() < 0.2:
+                    # new card
+                    card = (0, 0, i, 0, 0, 0, 0)
+                else:
+                    ivl = rng.randint(1, 365)
+                    card = (2, 2, today+rng.randint(-30, ivl), ivl,
+                            rng.randint(1300, 3000), rng.randint(1, 60),
+                            rng.randint(0, 8))
+                cards.append((card_id, note_id, deck_id, ord, crt+i, -1)+card+
+                             (0, 0, 0, 0, ''))
+        conn.executemany('insert into notes values (?,?,?,?,?,?,?,?,?,?,?)',
+                         notes)
+        conn.executemany('insert into cards values '
+                         '(?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)', cards)
+    conn.commit()
+    conn.close()
+
+# command -> (arguments, stdin), with stdin being one of the files created by
+# prepare_inputs
+benchmarks = {
+    'search': (['\\bred\\b', 'car'], None),
+    'search_field': (['^Back$', '\\bwhale\\b'], None),
+    'search_fields_only': (['caf'], None),
+    'search_tags': (['^color$'], None),
+    'search_cards': (['\\bbird\\b', 'sport'], None),
+    'list_decks': ([], None),
+    'list_models': ([], None),
+    'print_notes': ([], 'note_ids'),
+    'print_fields': ([], 'note_ids'),
+    'print_tags': ([], 'note_ids'),
+    'print_cards': ([], 'card_ids'),
+    'dump_notes': ([], 'note_ids'),
+    'dump_fields': ([], 'note_ids'),
+    'dump_tags': ([], 'note_ids'),
+    'dump_cards': ([], 'card_ids'),
+    'card_stats': ([], None),
+    'changes': ([], None),
+    'find_duplicates': (['^Front$'], None),
+    'add_notes': ([], 'records'),
+    'replace_fields': ([], 'fields'),
+    'replace_tags': ([], 'tags'),
+    'mv_tags': (['^leccion(\\d)$', 'spanish::leccion::\\1'], None),
+    'rm_tags': (['^history$'], None),
+    'update_index': ([], None),
+    }
+
+# searches the search index can answer -> (command, arguments), timed both
+# scanning the collection and with -i, once the index is built
+index_benchmarks = {
+    'exact tags': ('search_tags', ['^color$', '^bird$', '^sport$']),
+    'tag prefixes': ('search_tags', ['^animal::', '^leccion',
+                                     '^spanish::']),
+    'words': ('search', ['\\bwhale\\b', '\\bniño\\b']),
+    }
+
+def run_command(collection, command, arguments, stdin_path=None,
+                options=[]):
+    """Runs anki_tool in a process of its own and returns how long it took"""
+    stdin = open(stdin_path) if stdin_path else subprocess.DEVNULL
+    start = time.perf_counter()
+    subprocess.run([sys.executable, anki_tool_path, '-q', '-f', '-c',
+                    collection]+options+[command]+arguments,
+                   stdin=stdin, stdout=subprocess.DEVNULL, check=True)
+    elapsed = time.perf_counter()-start
+    if stdin_path:
+        stdin.close()
+    return elapsed
+
+def prepare_inputs(directory, collection):
+    """Creates the files fed to commands reading ids or json from stdin"""
+    def output(path, command, arguments, stdin_path=None):
+        with open(path, 'w') as stdout:
+            stdin = open(stdin_path) if stdin_path else subprocess.DEVNULL
+            subprocess.run([sys.executable, anki_tool_path, '-q', '-c',
+                            collection, command]+arguments,
+                           stdin=stdin, stdout=stdout, check=True)
+            if stdin_path:
+                stdin.close()
+        return path
+
+    inputs = dict()
+    inputs['note_ids'] = output(os.path.join(directory, 'note_ids'),
+                                'search', ['.'])
+    inputs['card_ids'] = output(os.path.join(directory, 'card_ids'),
+                                'search_cards', ['.'])
+    inputs['fields'] = output(os.path.join(directory, 'fields'), 'dump_fields',
+                              [], inputs['note_ids'])
+    inputs['tags'] = output(os.path.join(directory, 'tags'), 'dump_tags', [],
+                            inputs['note_ids'])
+    inputs['records'] = os.path.join(directory, 'records')
+    rng = random.Random(0)
+    with open(inputs['records'], 'w') as f:
+        for _ in range(10000):
+            model = rng.choice(['Basic', 'Basic (optional reversed card)'])
+            fields = {'Front': rng.choice(words), 'Back': rng.choice(words)}
+            if model != 'Basic':
+                fields['Reverse'] = rng.choice(['y', ''])
+            f.write(json.dumps({'model': model, 'deck': 'Languages::Spanish',
+                                'fields': fields,
+                                'tags': rng.sample(tags, rng.randint(0, 3))})+
+                    '\n')
+    return inputs
+
+def benchmark(directory, n, runs):
+    """Times every command against a collection with n notes. Returns a dict
+    mapping commands to their timings in seconds"""
+    collection = os.path.join(directory, 'collection_{}.anki2'.format(n))
+    if not os.path.exists(collection):
+        print('Generating collection with', n, 'notes...', file=sys.stderr)
+        generate_collection(collection, n)
+    inputs_dir = os.path.join(directory, 'inputs_{}'.format(n))
+    os.makedirs(inputs_dir, exist_ok=True)
+    inputs = prepare_inputs(inputs_dir, collection)
+    work = os.path.join(directory, 'work.anki2')
+
+    results = dict()
+    for command in sorted(anki_tool.commands):
+        if command not in benchmarks:
+            print('No benchmark for', command, 'skipping', file=sys.stderr)
+            continue
+        arguments, stdin = benchmarks[command]
+        times = []
+        for _ in range(runs):
+            # commands modifying the collection always start from a fresh copy
+            shutil.copyfile(collection, work)
+            index = os.path.splitext(work)[0]+'.anki_tool_index'
+            if os.path.exists(index):
+                os.remove(index)
+            times.append(run_command(work, command, arguments,
+                                     inputs.get(stdin)))
+        results[command] = {
+            'min': min(times),
+            'median': statistics.median(times),
+            'runs': runs,
+            }
+        print('{:>8} notes {:<20} {:8.3f}s'.format(n, command, min(times)),
+              file=sys.stderr)
+
+    # the first run with -i builds the index, and isn't timed
+    shutil.copyfile(collection, work)
+    index = os.path.splitext(work)[0]+'.anki_tool_index'
+    if os.path.exists(index):
+        os.remove(index)
+    run_command(work, 'update_index', [])
+    for name, (command, arguments) in sorted(index_benchmarks.items()):
+        for options in ([], ['-i']):
+            times = [run_command(work, command, arguments, options=options)
+                     for _ in range(runs)]
+            key = ' '.join([command]+options+['('+name+')'])
+            results[key] = {
+                'min': min(times),
+                'median': statistics.median(times),
+                'runs': runs,
+                }
+            print('{:>8} notes {:<35} {:8.3f}s'.format(n, key, min(times)),
+                  file=sys.stderr)
+    os.remove(index)
+    os.remove(work)
+    return results
+
+def benchmark_startup(directory, n, runs):
+    """Times a command doing almost no work, printing the tags of a single
+    note of the collection with n notes, run through anki_tool.py and through
+    the anki_tool launcher, against an interpreter doing nothing. Returns a
+    dict mapping each to its timings in seconds"""
+    collection = os.path.join(directory, 'collection_{}.anki2'.format(n))
+    with open(os.path.join(directory, 'inputs_{}'.format(n),
+                           'note_ids')) as f:
+        note_id = f.readline().strip()
+    arguments = ['-q', '-c', collection, 'print_tags', note_id]
+    startup_commands = {
+        'python': [sys.executable, '-c', 'pass'],
+        'anki_tool.py': [sys.executable, anki_tool_path]+arguments,
+        'anki_tool': [sys.executable, launcher_path]+arguments,
+        }
+    results = dict()
+    for name, command in sorted(startup_commands.items()):
+        # the first run writes the bytecode caches
+        subprocess.run(command, stdout=subprocess.DEVNULL, check=True)
+        times = []
+        # startup is short, so it's run more times to smooth out noise
+        for _ in range(runs*10):
+            start = time.perf_counter()
+            subprocess.run(command, stdout=subprocess.DEVNULL, check=True)
+            times.append(time.perf_counter()-start)
+        results[name] = {
+            'min': min(times),
+            'median': statistics.median(times),
+            'runs': runs*10,
+            }
+        print('startup {:<27} {:8.3f}s'.format(name, min(times)),
+              file=sys.stderr)
+    return results
+
+def compare(results, old_results):
+    """Prints how much slower or faster each command got to stderr"""
+    for name, timings in sorted(results['startup'].items()):
+        old = old_results.get('startup', dict()).get(name)
+        if not old:
+            continue
+        print('startup {:<27} {:8.3f}s -> {:8.3f}s ({:.2f}x)'.format(
+                  name, old['min'], timings['min'], timings['min']/old['min']),
+              file=sys.stderr)
+    for size in results['sizes']:
+        if size not in old_results['sizes']:
+            continue
+        for command, timings in sorted(results['sizes'][size].items()):
+            old = old_results['sizes'][size].get(command)
+            if not old:
+                continue
+            ratio = timings['min']/old['min']
+            print('{:>8} notes {:<20} {:8.3f}s -> {:8.3f}s ({:.2f}x)'.format(
+                      size, command, old['min'], timings['min'], ratio),
+                  file=sys.stderr)
+
+def run():
+    parser = argparse.ArgumentParser(description='Time anki_tool commands '
+                                                 'against synthetic '
+                                                 'collections')
+    parser.add_argument('-n', '--notes', dest='sizes', type=int,
+                        action='append', metavar='n',
+                        help='number of notes in a collection (may be used '
+                             'more than once, default: 10000)')
+    parser.add_argument('-r', '--runs', dest='runs', type=int, default=3,
+                        help='times each command is run (default: '
+                             '%(default)s)')
+    parser.add_argument('-d', '--directory', dest='directory',
+                        default='benchmark_data',
+                        help='where collections are generated and kept '
+                             'between runs (default: %(default)s)')
+    parser.add_argument('-o', '--output', dest='output',
+                        help='json file for the results (default: stdout)')
+    parser.add_argument('--compare', dest='compare', metavar='old_results',
+                        help='json file with results from another version to '
+                             'compare against')
+    opts = parser.parse_args()
+
+    os.makedirs(opts.directory, exist_ok=True)
+    results = {
+        'python': platform.python_version(),
+        'sqlite': sqlite3.sqlite_version,
+        'platform': platform.platform(),
+        'time': int(time.time()),
+        'sizes': dict(),
+        }
+    sizes = opts.sizes or [10000]
+    for n in sizes:
+        results['sizes'][str(n)] = benchmark(opts.directory, n, opts.runs)
+    results['startup'] = benchmark_startup(opts.directory, min(sizes),
+                                           opts.runs)
+
+    if opts.output:
+        with open(opts.output, 'w') as f:
+            json.dump(results, f, indent=1)
+    else:
+        print(json.dumps(results, indent=1))
+
+    if opts.compare:
+        with open(opts.compare) as f:
+            compare(results, json.load(f))
+
+if __name__ == '__main__':
+    run()
@@ -1,42 +1,38 @@
 #! /usr/bin/python3
-"""Add audio to notes lacking it. This is an example of how to manipulate notes' fields using anki_tool, which you can use as a base for your own application.
-Usage: anki_tool -q search . | anki_tool -q dump_fields | ./example_field_modifier.py | anki_tool -f replace_fields"""
+"""Add audio to notes lacking it. This is an example of how to manipulate notes' fields using anki_tool, which you can use as a base for your own application. Notes are searched, modified and written back in batches in a single process, streaming through the collection, without converting them to and from json.
+Usage: ./example_field_modifier.py [collection_db]"""
 
 import sys
-import json
 import re
+import sqlite3
 import anki_tool
 
-modified_notes = dict()
-# reading json produced by dump_fields from stdin
-for line in sys.stdin:
-    notes = json.loads(line.rstrip())
-    # getting back the original dict for each note
-    for _id in notes:
-        keys, values = notes[_id]
-        notes[_id] = anki_tool.lists_to_ordered_dict(keys, values)
-
-    for _id in notes:
-        note = notes[_id]
-        # if the note does not already contain audio
-        if ('Front' in note and 
-            not re.search(r'\[sound:[^\]+]', note['Front'])):
-
-            # getting first word in the field
-            word = re.search(r'^\w+', note['Front']).group()
-            # adding audio for that word
-            note['Front'] += '<div>[sound:'+word+'.mp3]</div>'
-
-            modified_notes[_id] = note
-
-# prepare notes for output, replacing dict with lists so we don't lose the field
-# order
-for _id in modified_notes:
-    modified_notes[_id] = anki_tool.ordered_dict_to_lists(modified_notes[_id])
-
-# also print our modification in a human-readable way
-for _id in modified_notes:
-    print(_id, modified_notes[_id], file=sys.stderr)
-
-# print result, which can be fed to replace_fields
-print(json.dumps(modified_notes))
+def add_audio(note):
+    # getting first word in the field
+    word = re.search(r'\w+', anki_tool.html_to_text(note.get('Front', '')))
+    if not word:
+        # leaving the note out of the notes written
+        return False
+    # adding audio for that word
+    note['Front'] += '<div>[sound:'+word.group()+'.mp3]</div>'
+    # also print our modification in a human-readable way
+    print(note.id, note['Front'], file=sys.stderr)
+
+if len(sys.argv) > 1:
+    collection = sys.argv[1]
+else:
+    collection = anki_tool.find_collection()
+if not collection:
+    print("Error: couldn't find collection.", file=sys.stderr)
+    exit(1)
+conn = sqlite3.connect(collection)
+
+# notes whose Front field does not already contain audio
+notes = anki_tool.select_notes(conn, [r'!\[sound:'], only_field='^Front$')
+notes = anki_tool.transform_notes(notes, add_audio)
+modified = anki_tool.write_notes(conn, notes)
+
+print(modified, 'notes modified', file=sys.stderr)
+if modified and anki_tool.prompt_confirmation():
+    conn.commit()
+conn.close()
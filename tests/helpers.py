@@ -0,0 +1,78 @@
+"""Helpers shared by the tests: collections generated as benchmark.py does,
+and anki_tool run on them as a separate process, as it's used"""
+
+import os
+import os.path
+import sys
+import shutil
+import sqlite3
+import subprocess
+import tempfile
+import unittest
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if root not in sys.path:
+    sys.path.insert(0, root)
+
+import anki_tool
+import benchmark
+
+anki_tool_path = os.path.join(root, 'anki_tool.py')
+
+class CollectionTestCase(unittest.TestCase):
+    """Gives each test a fresh copy of a collection with n notes, in a
+    directory of its own so the index and snapshot files next to it don't
+    leak between tests"""
+    n = 300
+
+    @classmethod
+    def setUpClass(cls):
+        cls.template_directory = tempfile.mkdtemp()
+        cls.template = os.path.join(cls.template_directory, 'template.anki2')
+        benchmark.generate_collection(cls.template, cls.n)
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.template_directory)
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.path = os.path.join(self.directory, 'collection.anki2')
+        shutil.copyfile(self.template, self.path)
+
+    def run_tool(self, *args, stdin='', status=0):
+        """Runs anki_tool on the collection and returns its stdout, checking
+        its exit status"""
+        process = subprocess.run([sys.executable, anki_tool_path,
+                                  '-c', self.path]+list(args),
+                                 input=stdin, stdout=subprocess.PIPE,
+                                 stderr=subprocess.PIPE,
+                                 universal_newlines=True)
+        self.assertEqual(process.returncode, status, process.stderr)
+        return process.stdout
+
+    def lines(self, *args, stdin=''):
+        return self.run_tool(*args, stdin=stdin).split()
+
+    def query(self, sql, params=()):
+        conn = sqlite3.connect(self.path)
+        try:
+            return conn.execute(sql, params).fetchall()
+        finally:
+            conn.close()
+
+    def modify(self, sql, params=()):
+        """Modifies the collection as another program would"""
+        conn = sqlite3.connect(self.path)
+        try:
+            conn.execute(sql, params)
+            conn.commit()
+        finally:
+            conn.close()
+
+    def connect(self):
+        conn = sqlite3.connect(self.path)
+        self.addCleanup(anki_tool.drop_caches, conn)
+        self.addCleanup(conn.close)
+        return conn
@@ -0,0 +1,76 @@
+"""anki_tool_async: collections opened together keep caches of their own, and
+their notes are the ones printed by the command line"""
+
+import asyncio
+import json
+import os.path
+import shutil
+import unittest
+
+from helpers import CollectionTestCase, anki_tool
+import anki_tool_async
+
+class AsyncTest(CollectionTestCase):
+
+    def setUp(self):
+        super().setUp()
+        # a second collection whose model calls its first field differently
+        # and which was created on another day
+        self.other_path = os.path.join(self.directory, 'other.anki2')
+        shutil.copyfile(self.path, self.other_path)
+        path, self.path = self.path, self.other_path
+        self.modify("update col set crt=crt+100*86400, "
+                    "models=replace(models,'\"Front\"','\"Vorne\"')")
+        self.path = path
+        self.note_ids = [row[0] for row in self.query(
+                             'select id from notes order by id limit 20')]
+
+    def dump(self, collection):
+        async def dump():
+            notes = []
+            async for note in collection.dump_notes(self.note_ids):
+                notes.append(note)
+            return notes
+        return dump()
+
+    def test_collections_keep_their_own_caches(self):
+        async def run():
+            first = await anki_tool_async.Collection.open(self.path)
+            second = await anki_tool_async.Collection.open(self.other_path)
+            # interleaving calls on both collections
+            results = await asyncio.gather(self.dump(first),
+                                           self.dump(second),
+                                           self.dump(first))
+            dates = await asyncio.gather(*[
+                collection.call(anki_tool.get_collection_creation_date,
+                                collection.conn)
+                for collection in (first, second)])
+            connections = [first.conn, second.conn]
+            await first.close()
+            await second.close()
+            return results, dates, connections
+        (first, second, again), dates, connections = asyncio.run(run())
+        self.assertEqual(first, again)
+        self.assertEqual(list(first[0]['fields'])[0], 'Front')
+        self.assertEqual(list(second[0]['fields'])[0], 'Vorne')
+        self.assertEqual((dates[1]-dates[0]).days, 100)
+        for conn in connections:
+            self.assertNotIn(conn, anki_tool.collection_caches)
+
+    def test_notes_are_the_command_line_ones(self):
+        async def run():
+            async with await anki_tool_async.Collection.open(
+                    self.path) as collection:
+                return await self.dump(collection)
+        notes = asyncio.run(run())
+        dumped = json.loads(self.run_tool('-q', 'dump_notes',
+                                          *map(str, self.note_ids)))
+        self.assertEqual(len(notes), len(self.note_ids))
+        for note in notes:
+            names, values = dumped[str(note['id'])]['fields']
+            self.assertEqual(list(note['fields'].items()),
+                             list(zip(names, values)))
+            self.assertNotIn('Reverse', note['fields'])
+
+if __name__ == '__main__':
+    unittest.main()
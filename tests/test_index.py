@@ -0,0 +1,81 @@
+"""The search index: searches with -i find what scanning the collection finds,
+even after the collection is modified, by anki_tool or by other programs"""
+
+import json
+import sqlite3
+import unittest
+
+from helpers import CollectionTestCase, anki_tool
+
+searches = [
+    ('search', '\\bwhale\\b'),
+    ('search', '\\bniño\\b', '^river'),
+    ('search', 'car'),
+    ('search_tags', '^color$'),
+    ('search_tags', '^animal::', '^leccion'),
+    ('search_tags', '^spanish::verbs$', 'nouns'),
+    ('search_cards', '\\bbird\\b'),
+    ]
+
+class IndexTest(CollectionTestCase):
+
+    def assertSameResults(self):
+        for search in searches:
+            scanned = self.run_tool('-q', *search)
+            self.assertTrue(scanned, search)
+            self.assertEqual(self.run_tool('-q', '-i', *search), scanned,
+                             search)
+
+    def test_searches(self):
+        self.assertSameResults()
+
+    def test_notes_modified_by_anki_tool(self):
+        self.run_tool('-q', 'update_index')
+        note_id = self.query('select id from notes limit 1')[0][0]
+        self.run_tool('-q', '-f', 'replace_tags',
+                      stdin=json.dumps({str(note_id): 'whale'}))
+        self.assertEqual(self.lines('-q', '-i', 'search_tags', '^whale$'),
+                         [str(note_id)])
+        self.assertSameResults()
+
+    def test_notes_added_and_deleted(self):
+        self.run_tool('-q', 'update_index')
+        added = self.run_tool('-q', '-f', 'add_notes', stdin=json.dumps(
+                    {'model': 'Basic', 'fields': ['whale', 'niño']})).split()
+        deleted = self.lines('-q', 'search', '\\bwhale\\b')[0]
+        self.modify('delete from notes where id=?', (deleted,))
+        found = self.lines('-q', '-i', 'search', '\\bwhale\\b')
+        self.assertIn(added[0], found)
+        self.assertNotIn(deleted, found)
+        self.assertSameResults()
+
+    def test_notes_synced_from_another_device(self):
+        self.run_tool('-q', 'update_index')
+        # sync keeps the time notes were edited on the other device, and only
+        # raises their usn
+        note_id = self.query('select id from notes order by mod limit 1')[0][0]
+        self.modify("update notes set tags=' synced ',usn=100 where id=?",
+                    (note_id,))
+        self.assertEqual(self.lines('-q', '-i', 'search_tags', '^synced$'),
+                         [str(note_id)])
+
+    def test_unmodified_collection_is_not_read(self):
+        conn = self.connect()
+        index = sqlite3.connect(anki_tool.get_index_path(conn))
+        self.addCleanup(index.close)
+        index.executescript(anki_tool.index_schema)
+        self.assertEqual(anki_tool.update_index(conn, index), self.n)
+        statements = []
+        conn.set_trace_callback(statements.append)
+        self.assertEqual(anki_tool.update_index(conn, index), 0)
+        self.assertEqual([statement for statement in statements
+                          if 'from notes' in statement], [])
+        # another program modifying a note, as anki does
+        self.modify('update notes set flds=?,mod=mod+1000000 where id=?',
+                    ('whale\x1fwhale\x1f', self.query(
+                         'select id from notes limit 1')[0][0]))
+        self.assertEqual(anki_tool.update_index(conn, index), 1)
+        self.assertEqual(anki_tool.update_index(conn, index), 0)
+
+if __name__ == '__main__':
+    unittest.main()
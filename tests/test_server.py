@@ -0,0 +1,47 @@
+"""serve: requests run on the served collection only, and their changes and
+output are only kept when they're committed with -f"""
+
+import json
+import os.path
+import shutil
+import unittest
+
+from helpers import CollectionTestCase, anki_tool
+
+class ServerTest(CollectionTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.conn = self.connect()
+        self.parser = anki_tool.create_parser()
+
+    def request(self, *argv, stdin=None):
+        return anki_tool.handle_request(self.conn, self.parser,
+                                        {'argv': list(argv), 'stdin': stdin})
+
+    def test_other_collections_are_refused(self):
+        other = os.path.join(self.directory, 'other.anki2')
+        shutil.copyfile(self.path, other)
+        response = self.request('-q', '-c', other, 'list_models')
+        self.assertEqual((response['status'], response['stdout']), (1, ''))
+        self.assertIn('Error', response['stderr'])
+        # naming the served collection, as the command line would
+        self.assertEqual(self.request('-q', '-c', self.path,
+                                      'list_models')['status'], 0)
+        self.assertEqual(self.request('-q', 'serve')['status'], 1)
+
+    def test_changes_are_committed_with_force_only(self):
+        record = json.dumps({'model': 'Basic', 'fields': ['perro', 'dog']})
+        before = self.query('select count() from notes')[0][0]
+        response = self.request('-q', 'add_notes', stdin=record)
+        self.assertEqual((response['status'], response['stdout']), (2, ''))
+        self.assertEqual(self.query('select count() from notes')[0][0],
+                         before)
+        response = self.request('-q', '-f', 'add_notes', stdin=record)
+        self.assertEqual(response['status'], 0)
+        self.assertEqual(self.query('select id from notes where flds=?',
+                                    ('perro\x1fdog',)),
+                         [(int(response['stdout']),)])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,49 @@
+"""The snapshot: commands run with --snapshot print what they print without
+it, and the snapshot is built again once the collection is modified"""
+
+import json
+import os.path
+import unittest
+
+from helpers import CollectionTestCase
+
+commands = [
+    ('search', '\\bwhale\\b', 'car'),
+    ('search_tags', '^color$'),
+    ('search_cards', '\\bbird\\b'),
+    ('-m', 'Basic', 'search', 'blue'),
+    ('-d', 'Geography', 'search_cards', 'red'),
+    ('card_stats',),
+    ]
+
+class SnapshotTest(CollectionTestCase):
+
+    def assertSameOutput(self):
+        for command in commands:
+            self.assertEqual(self.run_tool('-q', '--snapshot', *command),
+                             self.run_tool('-q', *command), command)
+
+    def test_commands(self):
+        self.assertSameOutput()
+        self.assertTrue(os.path.exists(os.path.splitext(self.path)[0]+
+                                       '.anki_tool_snapshot'))
+
+    def test_modified_by_anki_tool(self):
+        self.run_tool('-q', '--snapshot', 'search', 'whale')
+        note_id = self.query('select id from notes limit 1')[0][0]
+        self.run_tool('-q', '-f', 'replace_tags',
+                      stdin=json.dumps({str(note_id): 'snapshot'}))
+        self.assertEqual(self.lines('-q', '--snapshot', 'search_tags',
+                                    '^snapshot$'), [str(note_id)])
+
+    def test_modified_by_another_program(self):
+        self.run_tool('-q', '--snapshot', 'card_stats')
+        self.modify('update cards set due=due+7 where type=2')
+        self.modify("update notes set tags=' snapshot ' where id=(select "
+                    "min(id) from notes)")
+        self.assertSameOutput()
+        self.assertEqual(len(self.lines('-q', '--snapshot', 'search_tags',
+                                        '^snapshot$')), 1)
+
+if __name__ == '__main__':
+    unittest.main()
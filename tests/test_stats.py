@@ -0,0 +1,38 @@
+"""card_stats: the statistics computed with numpy, when it's installed, are
+the ones computed without it"""
+
+import unittest
+
+from helpers import CollectionTestCase, anki_tool
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+class StatsTest(CollectionTestCase):
+
+    @unittest.skipUnless(numpy, 'numpy is not installed')
+    def test_numpy(self):
+        conn = self.connect()
+        card_ids = [row[0] for row in self.query(
+                        'select id from cards order by id limit 50')]
+        for ids in (None, card_ids):
+            columns = anki_tool.read_stats_columns(conn, ids)
+            for today in (0, 2000, 4000):
+                self.assertEqual(
+                    anki_tool.compute_stats_numpy(numpy, columns, today),
+                    anki_tool.compute_stats(columns, today))
+
+    def test_card_ids(self):
+        card_ids = [str(row[0]) for row in self.query(
+                        'select id from cards where type=2 limit 3')]
+        stats = self.run_tool('-q', 'card_stats', *card_ids)
+        self.assertIn('"cards": 3,', stats)
+        # without ids, every card is counted
+        self.assertIn('"cards": {},'.format(
+                          self.query('select count() from cards')[0][0]),
+                      self.run_tool('-q', 'card_stats'))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,157 @@
+"""Commands and functions modifying notes: what they write, and that nothing
+is written or reported when their changes aren't committed"""
+
+import json
+import unittest
+
+from helpers import CollectionTestCase, anki_tool
+
+class AddNotesTest(CollectionTestCase):
+    records = ''.join(json.dumps(record)+'\n' for record in (
+        {'model': 'Basic', 'deck': 'Geography',
+         'fields': {'Front': 'perro', 'Back': 'dog'}, 'tags': ['animal']},
+        {'model': 'Basic (optional reversed card)',
+         'fields': ['gato', 'cat', 'y'], 'tags': 'animal pet'},
+        {'model': 'Basic', 'fields': {'Front': '', 'Back': 'no cards'}},
+        ))
+
+    def test_prints_ids_of_committed_notes(self):
+        before = self.query('select count() from notes')[0][0]
+        ids = [int(_id) for _id in
+               self.lines('-q', '-f', 'add_notes', stdin=self.records)]
+        self.assertEqual(len(ids), 2)
+        self.assertEqual(self.query('select count() from notes')[0][0],
+                         before+2)
+        rows = self.query('select id,flds,tags,usn from notes where id in '
+                          '(?,?) order by id', ids)
+        self.assertEqual(rows, [
+            (ids[0], 'perro\x1fdog', ' animal ', -1),
+            (ids[1], 'gato\x1fcat\x1fy', ' animal pet ', -1)])
+        # one card per template showing a field, as new cards
+        cards = self.query('select nid,ord,type,queue from cards '
+                           'where nid in (?,?) order by nid,ord', ids)
+        self.assertEqual(cards, [(ids[0], 0, 0, 0), (ids[1], 0, 0, 0),
+                                 (ids[1], 1, 0, 0)])
+        tags = json.loads(self.query('select tags from col')[0][0])
+        self.assertIn('pet', tags)
+
+    def test_prints_nothing_when_canceled(self):
+        before = self.query('select count() from notes')[0][0]
+        # with -q, there's no one to confirm the changes
+        self.assertEqual(self.run_tool('-q', 'add_notes', stdin=self.records,
+                                       status=2), '')
+        self.assertEqual(self.query('select count() from notes')[0][0],
+                         before)
+
+class TagsTest(CollectionTestCase):
+
+    def tagged(self, tag):
+        return [row[0] for row in self.query(
+                    "select id from notes where tags like ? order by id",
+                    ('% '+tag+' %',))]
+
+    def test_rm_tags(self):
+        self.assertTrue(self.tagged('history'))
+        self.run_tool('-q', '-f', 'rm_tags', '^history$')
+        self.assertEqual(self.tagged('history'), [])
+        tags = json.loads(self.query('select tags from col')[0][0])
+        self.assertNotIn('history', tags)
+
+    def test_mv_tags(self):
+        tagged = self.tagged('leccion1')
+        self.assertTrue(tagged)
+        self.run_tool('-q', '-f', 'mv_tags', '^leccion(\\d)$',
+                      'spanish::leccion::\\1')
+        self.assertEqual(self.tagged('leccion1'), [])
+        self.assertEqual(self.tagged('spanish::leccion::1'), tagged)
+        self.assertEqual(self.query("select usn from notes where id=?",
+                                    (tagged[0],)), [(-1,)])
+
+class ReplaceTest(CollectionTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.modify('update notes set usn=5')
+        self.ids = [row[0] for row in self.query(
+                        'select id from notes order by id limit 5')]
+
+    def test_replace_fields(self):
+        fields = json.loads(self.run_tool('-q', 'dump_fields',
+                                          *map(str, self.ids)))
+        for note_id, (names, values) in fields.items():
+            values[0] = 'new front '+note_id
+        self.run_tool('-q', '-f', 'replace_fields', stdin=json.dumps(fields))
+        for note_id, flds, usn in self.query(
+                'select id,flds,usn from notes where id in ({})'.format(
+                    ','.join(map(str, self.ids)))):
+            self.assertTrue(flds.startswith('new front {}\x1f'.format(
+                                                note_id)))
+            self.assertEqual(usn, -1)
+        self.assertEqual(self.query('select count() from notes '
+                                    'where usn=-1')[0][0], len(self.ids))
+
+    def test_replace_tags(self):
+        tags = dict((str(_id), 'replaced '+str(_id)) for _id in self.ids)
+        self.run_tool('-q', '-f', 'replace_tags', stdin=json.dumps(tags))
+        self.assertEqual(
+            json.loads(self.run_tool('-q', 'dump_tags', *tags)),
+            dict((_id, ' {} '.format(value)) for _id, value in tags.items()))
+
+    def test_malformed_notes_are_skipped(self):
+        fields = {str(self.ids[0]): [['Front', 'Back'], ['a', 'b']],
+                  str(self.ids[1]): 'malformed'}
+        self.run_tool('-q', '-f', 'replace_fields', stdin=json.dumps(fields))
+        self.assertEqual(self.query('select id from notes where usn=-1'),
+                         [(self.ids[0],)])
+
+    def test_nothing_is_written_when_canceled(self):
+        tags = dict((str(_id), 'replaced') for _id in self.ids)
+        self.run_tool('-q', 'replace_tags', stdin=json.dumps(tags), status=2)
+        self.assertEqual(self.query('select count() from notes '
+                                    'where usn=-1')[0][0], 0)
+
+class NotesWriterTest(CollectionTestCase):
+
+    def test_failing_notes_are_skipped(self):
+        conn = self.connect()
+        ids = [row[0] for row in conn.execute(
+                   'select id from notes order by id limit 10')]
+        # a note that can't be modified makes its whole batch fail
+        conn.execute("create trigger refuse before update on notes "
+                     "when new.id={} begin select raise(abort, 'refused'); "
+                     "end".format(ids[3]))
+        writer = anki_tool.NotesWriter(conn, ['tags'], size=4)
+        renderer = anki_tool.renderer
+        # collecting the messages instead of writing them
+        anki_tool.renderer = anki_tool.Renderer(1 << 16)
+        anki_tool.renderer.interleaved = False
+        try:
+            for _id in ids:
+                writer.add(_id, ' written ')
+            writer.flush()
+            messages = ''.join(anki_tool.renderer.err_chunks)
+        finally:
+            anki_tool.renderer = renderer
+        self.assertEqual((writer.written, writer.failed), (9, 1))
+        self.assertIn("Couldn't modify note {}".format(ids[3]), messages)
+        conn.commit()
+        self.assertEqual(self.query("select id from notes "
+                                    "where tags=' written ' order by id"),
+                         [(_id,) for _id in ids if _id != ids[3]])
+
+    def test_write_notes_updates_sort_field_and_checksum(self):
+        conn = self.connect()
+        notes = list(anki_tool.read_notes(conn, [row[0] for row in self.query(
+                    'select id from notes order by id limit 3')]))
+        notes[0]['Front'] = '<b>sort</b> me'
+        notes[0].tags.append('written')
+        self.assertEqual(anki_tool.write_notes(conn, notes), 1)
+        conn.commit()
+        self.assertEqual(self.query('select flds,tags,sfld,csum from notes '
+                                    'where id=?', (notes[0].id,)),
+                         [('\x1f'.join(notes[0].values),
+                           ' {} '.format(' '.join(notes[0].tags)), 'sort me',
+                           anki_tool.field_checksum('sort me'))])
+
+if __name__ == '__main__':
+    unittest.main()